@@ -16,3 +16,10 @@
 
 class YamconvError(Exception):
     pass
+
+
+class RecordError(YamconvError):
+    # A malformed record, which can be skipped.
+    def __init__(self, msg, record=None):
+        super(RecordError, self).__init__(msg)
+        self.record = record
@@ -0,0 +1,93 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the codec of compressed texts.
+>>> texts = ['the quick brown fox', 'the lazy dog', '世界，你好！']
+>>> zdict = train_dictionary(texts)
+>>> for method, zd in [('zlib', None), ('zlib', zdict), ('lzma', None)]:
+...     codec = TextCodec(method, zd)
+...     print([codec.decompress(codec.compress(t)) for t in texts] == texts)
+True
+True
+True
+"""
+
+import lzma
+import zlib
+from collections import Counter
+from common.ex import YamconvError
+
+COMPRESSION_METHODS = ['zlib', 'lzma']
+# The maximum size of a zlib dictionary
+MAX_DICT_SIZE = 32768
+# A small dictionary is enough for a text, and much faster to set up for
+# each text than that of the preset.
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6, 'dict_size': 1 << 16}]
+# The dictionary of the preset also decodes the texts compressed with it.
+LZMA_DECODE_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+
+
+def train_dictionary(texts):
+    """Builds a zlib dictionary from the most frequent words of sample texts.
+    The most frequent words are placed at the end, where zlib finds them with
+    the shortest distances."""
+    counter = Counter()
+    for text in texts:
+        counter.update(text.split())
+    words = []
+    size = 0
+    for word, count in counter.most_common():
+        if count < 2:
+            break
+        size += len(word.encode('utf-8')) + 1
+        if size > MAX_DICT_SIZE:
+            break
+        words.append(word)
+    return ' '.join(reversed(words)).encode('utf-8')
+
+
+class TextCodec:
+    def __init__(self, method, zdict=None):
+        if method not in COMPRESSION_METHODS:
+            raise YamconvError(
+                'Unknown text compression method {}'.format(method))
+        if zdict and method != 'zlib':
+            raise YamconvError(
+                'Dictionary is only supported by zlib compression')
+        self.method = method
+        self.zdict = zdict
+
+    def compress(self, text):
+        data = text.encode('utf-8')
+        if self.method == 'lzma':
+            # The raw format omits the headers, which are relatively large
+            # for short texts.
+            return lzma.compress(
+                data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+        if self.zdict:
+            compressor = zlib.compressobj(zdict=self.zdict)
+            return compressor.compress(data) + compressor.flush()
+        return zlib.compress(data)
+
+    def decompress(self, blob):
+        if self.method == 'lzma':
+            data = lzma.decompress(
+                blob, format=lzma.FORMAT_RAW, filters=LZMA_DECODE_FILTERS)
+        elif self.zdict:
+            decompressor = zlib.decompressobj(zdict=self.zdict)
+            data = decompressor.decompress(blob) + decompressor.flush()
+        else:
+            data = zlib.decompress(blob)
+        return data.decode('utf-8')
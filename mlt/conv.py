@@ -16,15 +16,65 @@
 from mlt.fasttext import FastTextReader, FastTextWriter
 from mlt.sqlite import SQLiteReader, SQLiteWriter
 from mlt.csv import CSVReader, CSVWriter
+from mlt.csr import CSRWriter
+from mlt.fanout import FanOutWriter
+from common.ex import YamconvError
 from mlt.formatter import Normalizer, Formatter, FromFastText, ToFastText
 from mlt.mlt import Converter
 
+FASTTEXT = 'fasttext'
+SQLITE = 'sqlite'
+CSV = 'csv'
+CSR = 'csr'
+INPUT_FORMATS = [FASTTEXT, SQLITE, CSV]
+OUTPUT_FORMATS = [FASTTEXT, SQLITE, CSV, CSR]
+
+
+def get_reader(in_format, in_path):
+    if in_format == FASTTEXT:
+        return FastTextReader(in_path)
+    if in_format == SQLITE:
+        return SQLiteReader(in_path)
+    if in_format == CSV:
+        return CSVReader(in_path)
+    raise YamconvError('Unknown input format {}'.format(in_format))
+
+
+def get_from_formatter(in_format, cache_labels):
+    if in_format == SQLITE:
+        return Formatter(cache_labels=cache_labels)
+    return FromFastText(cache_labels=cache_labels)
+
+
+def get_to_formatter(out_format, normalize_labels, word_seq, cache_labels):
+    if out_format == FASTTEXT:
+        return ToFastText(
+            normalize_labels=normalize_labels,
+            word_seq=word_seq,
+            cache_labels=cache_labels)
+    return Normalizer(
+        normalize_labels=normalize_labels,
+        word_seq=word_seq,
+        cache_labels=cache_labels)
+
+
+def get_writer(out_format, out_path, reader, to_formatter):
+    if out_format == FASTTEXT:
+        return FastTextWriter(out_path)
+    if out_format == SQLITE:
+        return SQLiteWriter(out_path)
+    if out_format == CSV:
+        return CSVWriter(out_path, reader, to_formatter)
+    if out_format == CSR:
+        return CSRWriter(out_path)
+    raise YamconvError('Unknown output format {}'.format(out_format))
+
 
 class FastText2SQLite(Converter):
     def __init__(self, fasttext_path, sqlite_path,
                  normalize_labels, word_seq,
                  cache_labels,
-                 logger, nlines):
+                 logger, nlines, **kwargs):
         reader = FastTextReader(fasttext_path)
         from_formatter = FromFastText(
             cache_labels=cache_labels)
@@ -34,14 +84,15 @@ class FastText2SQLite(Converter):
             word_seq=word_seq,
             cache_labels=cache_labels)
         super(self.__class__, self).__init__(
-            reader, from_formatter, writer, to_formatter, logger, nlines)
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
 
 
 class SQLite2FastText(Converter):
     def __init__(self, sqlite_path, fasttext_path,
                  normalize_labels, word_seq,
                  cache_labels,
-                 logger, nlines):
+                 logger, nlines, **kwargs):
         reader = SQLiteReader(sqlite_path)
         from_formatter = Formatter(
             cache_labels=cache_labels)
@@ -51,14 +102,15 @@ class SQLite2FastText(Converter):
             word_seq=word_seq,
             cache_labels=cache_labels)
         super(self.__class__, self).__init__(
-            reader, from_formatter, writer, to_formatter, logger, nlines)
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
 
 
 class FastText2FastText(Converter):
     def __init__(self, in_path, out_path,
                  normalize_labels, word_seq,
                  cache_labels,
-                 logger, nlines):
+                 logger, nlines, **kwargs):
         reader = FastTextReader(in_path)
         from_formatter = FromFastText(
             cache_labels=cache_labels)
@@ -68,14 +120,16 @@ class FastText2FastText(Converter):
             word_seq=word_seq,
             cache_labels=cache_labels)
         super(self.__class__, self).__init__(
-            reader, from_formatter, writer, to_formatter, logger, nlines)
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            passthrough=not normalize_labels and not word_seq,
+            **kwargs)
 
 
 class SQLite2SQLite(Converter):
     def __init__(self, in_path, out_path,
                  normalize_labels, word_seq,
                  cache_labels,
-                 logger, nlines):
+                 logger, nlines, **kwargs):
         reader = SQLiteReader(in_path)
         from_formatter = Formatter(
             cache_labels=cache_labels)
@@ -85,14 +139,15 @@ class SQLite2SQLite(Converter):
             word_seq=word_seq,
             cache_labels=cache_labels)
         super(self.__class__, self).__init__(
-            reader, from_formatter, writer, to_formatter, logger, nlines)
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
 
 
 class CSV2SQLite(Converter):
     def __init__(self, in_path, out_path,
                  normalize_labels, word_seq,
                  cache_labels, logger,
-                 nlines):
+                 nlines, **kwargs):
         reader = CSVReader(in_path)
         from_formatter = FromFastText(
             cache_labels=cache_labels)
@@ -102,14 +157,15 @@ class CSV2SQLite(Converter):
             word_seq=word_seq,
             cache_labels=cache_labels)
         super(self.__class__, self).__init__(
-            reader, from_formatter, writer, to_formatter, logger, nlines)
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
 
 
 class CSV2FastText(Converter):
     def __init__(self, in_path, out_path,
                  normalize_labels, word_seq,
                  cache_labels, logger,
-                 nlines):
+                 nlines, **kwargs):
         reader = CSVReader(in_path)
         from_formatter = FromFastText(
             cache_labels=cache_labels)
@@ -119,14 +175,15 @@ class CSV2FastText(Converter):
             word_seq=word_seq,
             cache_labels=cache_labels)
         super(self.__class__, self).__init__(
-            reader, from_formatter, writer, to_formatter, logger, nlines)
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
 
 
 class SQLite2CSV(Converter):
     def __init__(self, sqlite_path, csv_path,
                  normalize_labels, word_seq,
                  cache_labels,
-                 logger, nlines):
+                 logger, nlines, **kwargs):
         reader = SQLiteReader(sqlite_path)
         from_formatter = Formatter(
             cache_labels=cache_labels)
@@ -136,14 +193,15 @@ class SQLite2CSV(Converter):
             cache_labels=cache_labels)
         writer = CSVWriter(csv_path, reader, to_formatter)
         super(self.__class__, self).__init__(
-            reader, from_formatter, writer, to_formatter, logger, nlines)
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
 
 
 class CSV2CSV(Converter):
     def __init__(self, in_path, out_path,
                  normalize_labels, word_seq,
                  cache_labels, logger,
-                 nlines):
+                 nlines, **kwargs):
         reader = CSVReader(in_path)
         from_formatter = FromFastText(
             cache_labels=cache_labels)
@@ -153,4 +211,98 @@ class CSV2CSV(Converter):
             cache_labels=cache_labels)
         writer = CSVWriter(out_path, reader, to_formatter)
         super(self.__class__, self).__init__(
-            reader, from_formatter, writer, to_formatter, logger, nlines)
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            passthrough=not normalize_labels and not word_seq,
+            **kwargs)
+
+
+class FastText2CSR(Converter):
+    def __init__(self, in_path, out_path,
+                 normalize_labels, word_seq,
+                 cache_labels,
+                 logger, nlines, **kwargs):
+        reader = FastTextReader(in_path)
+        from_formatter = FromFastText(
+            cache_labels=cache_labels)
+        writer = CSRWriter(out_path)
+        to_formatter = Normalizer(
+            normalize_labels=normalize_labels,
+            word_seq=word_seq,
+            cache_labels=cache_labels)
+        super(self.__class__, self).__init__(
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
+
+
+class SQLite2CSR(Converter):
+    def __init__(self, in_path, out_path,
+                 normalize_labels, word_seq,
+                 cache_labels,
+                 logger, nlines, **kwargs):
+        reader = SQLiteReader(in_path)
+        from_formatter = Formatter(
+            cache_labels=cache_labels)
+        writer = CSRWriter(out_path)
+        to_formatter = Normalizer(
+            normalize_labels=normalize_labels,
+            word_seq=word_seq,
+            cache_labels=cache_labels)
+        super(self.__class__, self).__init__(
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
+
+
+class CSV2CSR(Converter):
+    def __init__(self, in_path, out_path,
+                 normalize_labels, word_seq,
+                 cache_labels,
+                 logger, nlines, **kwargs):
+        reader = CSVReader(in_path)
+        from_formatter = FromFastText(
+            cache_labels=cache_labels)
+        writer = CSRWriter(out_path)
+        to_formatter = Normalizer(
+            normalize_labels=normalize_labels,
+            word_seq=word_seq,
+            cache_labels=cache_labels)
+        super(self.__class__, self).__init__(
+            reader, from_formatter, writer, to_formatter, logger, nlines,
+            **kwargs)
+
+
+class FanOut(Converter):
+    """Reads and normalizes the input once for several outputs. Each output
+    is a dict of its format, path, normalize_labels and word_seq, and
+    optionally text_compression, compression_dict and fts_index."""
+
+    def __init__(self, in_format, in_path, outputs,
+                 cache_labels,
+                 logger, nlines, **kwargs):
+        reader = get_reader(in_format, in_path)
+        from_formatter = get_from_formatter(in_format, cache_labels)
+        writers = []
+        for output in outputs:
+            if output['format'] == CSV and in_format == FASTTEXT:
+                raise YamconvError(
+                    'Output file {} needs the labels of a SQLite or CSV '
+                    'input.'.format(output['path']))
+            to_formatter = get_to_formatter(
+                output['format'], output['normalize_labels'],
+                output['word_seq'], cache_labels)
+            writer = get_writer(
+                output['format'], output['path'], reader, to_formatter)
+            if output.get('text_compression') and not writer.set_compression(
+                    output['text_compression'],
+                    output.get('compression_dict', False)):
+                raise YamconvError(
+                    'Output file {} does not support text compression.'
+                    .format(writer.filepath))
+            if output.get('fts_index') and not writer.set_fts_index():
+                raise YamconvError(
+                    'Output file {} does not support full-text index.'
+                    .format(writer.filepath))
+            writers.append((writer, to_formatter))
+        # The records are formatted for each output by the writer.
+        super(self.__class__, self).__init__(
+            reader, from_formatter, FanOutWriter(writers), Formatter(),
+            logger, nlines, **kwargs)
@@ -0,0 +1,154 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the writer of a sparse CSR label matrix.
+The texts are written line by line to the output file, and the matrix is
+written next to it as `.npy` arrays, which can be loaded by
+`numpy.load(path, mmap_mode='r')` into `scipy.sparse.csr_matrix`.
+>>> import os, tempfile
+>>> from mlt.mlt import MultiLabelText
+>>> path = os.path.join(tempfile.mkdtemp(), 'out.txt')
+>>> writer = CSRWriter(path)
+>>> writer.open()
+>>> for text, labels in [('a b', ['x', 'y']), ('c', []), ('d\\ne', ['y'])]:
+...     mlt = MultiLabelText(text)
+...     for label in labels:
+...         mlt.add_label(label)
+...     writer.write(mlt)
+>>> writer.close()
+>>> list(load_npy(path + INDPTR_SUFFIX))
+[0, 2, 2, 3]
+>>> vocab = open(path + VOCAB_SUFFIX).read().split()
+>>> sorted(vocab[i] for i in load_npy(path + INDICES_SUFFIX)[:2])
+['x', 'y']
+>>> open(path).read()
+'a b\\nc\\nd e\\n'
+"""
+
+import ast
+import sys
+import struct
+from array import array
+from mlt.mlt import Writer
+
+INDPTR_SUFFIX = '.indptr.npy'
+INDICES_SUFFIX = '.indices.npy'
+VOCAB_SUFFIX = '.labels.txt'
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# The header is padded to a fixed size, so that the final shape can be
+# written over it when the array is closed.
+NPY_HEADER_SIZE = 128
+NPY_DTYPES = {'q': '<i8', 'i': '<i4'}
+# The number of values buffered before they are appended to a file
+BUFFER_SIZE = 65536
+
+
+def npy_header(typecode, length):
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}"\
+        .format(NPY_DTYPES[typecode], length)
+    header = header.ljust(NPY_HEADER_SIZE - len(NPY_MAGIC) - 3) + '\n'
+    return NPY_MAGIC + struct.pack('<H', len(header)) + \
+        header.encode('latin1')
+
+
+def load_npy(path):
+    """Loads a one-dimensional array written by `NpyArrayWriter`."""
+    with open(path, 'rb') as f:
+        f.read(len(NPY_MAGIC))
+        header_len, = struct.unpack('<H', f.read(2))
+        header = ast.literal_eval(f.read(header_len).decode('latin1'))
+        typecode = [t for t, d in NPY_DTYPES.items()
+                    if d == header['descr']][0]
+        values = array(typecode)
+        values.frombytes(f.read())
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+class NpyArrayWriter:
+    """Appends integers to a one-dimensional `.npy` file."""
+
+    def __init__(self, path, typecode):
+        self.path = path
+        self.typecode = typecode
+
+    def open(self):
+        self.length = 0
+        self.buffer = array(self.typecode)
+        self.npy_file = open(self.path, 'wb')
+        self.npy_file.write(npy_header(self.typecode, 0))
+
+    def append(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def extend(self, values):
+        self.buffer.extend(values)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if sys.byteorder != 'little':
+            self.buffer.byteswap()
+        self.buffer.tofile(self.npy_file)
+        self.length += len(self.buffer)
+        self.buffer = array(self.typecode)
+
+    def close(self):
+        self.flush()
+        self.npy_file.seek(0)
+        self.npy_file.write(npy_header(self.typecode, self.length))
+        self.npy_file.close()
+
+
+class CSRWriter(Writer):
+    def __init__(self, text_path):
+        super(self.__class__, self).__init__(text_path)
+
+    def open(self):
+        self.text_file = open(self.filepath, 'w')
+        self.vocab_file = open(self.filepath + VOCAB_SUFFIX, 'w')
+        self.indptr = NpyArrayWriter(self.filepath + INDPTR_SUFFIX, 'q')
+        self.indices = NpyArrayWriter(self.filepath + INDICES_SUFFIX, 'i')
+        self.indptr.open()
+        self.indices.open()
+        self.indptr.append(0)
+        self.vocab = {}
+        self.nnz = 0
+
+    def label_index(self, label):
+        # The labels are numbered in the order they first occur.
+        i = self.vocab.get(label)
+        if i is None:
+            i = len(self.vocab)
+            self.vocab[label] = i
+            print(label, file=self.vocab_file)
+        return i
+
+    def write(self, mlt):
+        # Line breaks are replaced to keep the texts aligned with the rows.
+        print(' '.join(mlt.text.splitlines()), file=self.text_file)
+        cols = sorted(self.label_index(l) for l in mlt.labels)
+        self.indices.extend(cols)
+        self.nnz += len(cols)
+        self.indptr.append(self.nnz)
+
+    def close(self):
+        self.indptr.close()
+        self.indices.close()
+        self.vocab_file.close()
+        self.text_file.close()
@@ -13,13 +13,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+"""This module contains the reader and writer of CSV files.
+>>> import os, tempfile
+>>> from mlt.index import Indexer
+>>> path = os.path.join(tempfile.mkdtemp(), 'data.csv')
+>>> with open(path, 'w', newline='') as f:
+...     _ = f.write('id,text,a,b\\n1,one,1,0\\n\\n2,"two\\n\\nlines",0,1\\n'
+...                 '3,three,1,1\\n\\n4,"four\\nlines",1,0\\n5,five,0,0\\n'
+...                 '6,six,1,0\\n')
+>>> def ids(mlts):
+...     return [mlt.idstr for mlt in mlts]
+>>> reader = CSVReader(path)
+>>> reader.open()
+>>> sequential = ids(iter(reader.read, None))
+>>> reader.close()
+>>> sequential
+['1', '2', '3', '4', '5', '6']
+>>> Indexer(path, path + '.idx', is_csv=True).convert()
+>>> reader.open()
+>>> reader.partitions(2)
+[(0, 1), (2, 3), (4, 5)]
+>>> ids(m for p in reader.partitions(2) for m in reader.read_partition(p))
+['1', '2', '3', '4', '5', '6']
+>>> reader.close()
+"""
+
 import os
 import csv
-from common.ex import YamconvError
-from mlt.mlt import MultiLabelText, Reader, Writer
+from itertools import compress, islice
+from common.ex import YamconvError, RecordError
+from mlt.mlt import MultiLabelText, Writer
+from mlt.index import IndexedReader, check_decoded, ends_in_quotes
+
+ONE = '1'
+# The number of rows read in a chunk
+CHUNK_ROWS = 10000
 
 
-class CSVReader(Reader):
+class CSVReader(IndexedReader):
     def __init__(self, csv_path):
         super(self.__class__, self).__init__(csv_path)
 
@@ -27,10 +58,11 @@ class CSVReader(Reader):
         if not os.path.isfile(self.filepath):
             raise YamconvError(
                 'Input file {} does not exists.'.format(self.filepath))
-        self.csv_file = open(self.filepath, 'r')
+        self.csv_file = open(
+            self.filepath, 'r', newline='', errors='surrogateescape')
         self.reader = csv.reader(self.csv_file)
         try:
-            header = next(self.reader)
+            header = self.next_row()
             if header[0].strip().lower() == 'id':
                 self.has_id = True
             else:
@@ -44,44 +76,115 @@ class CSVReader(Reader):
             raise YamconvError('Failed to read header row: {}'.format(e))
         if not self.labels:
             raise YamconvError('No labels found')
+        self.open_index()
+        if self.follow and self.follow_offset:
+            self.seek_offset(self.follow_offset)
+
+    def data_file(self):
+        return self.csv_file
+
+    def record_complete(self, lines):
+        # A record is incomplete within a quoted field.
+        in_quotes = False
+        for line in lines:
+            in_quotes = ends_in_quotes(line, in_quotes)
+        return not in_quotes
+
+    def next_row(self):
+        if self.follow:
+            self.line = self.follow_line + 1
+            return next(csv.reader(self.follow_lines()), [])
+        # The line where the row starts
+        self.line = self.reader.line_num + 1
+        return next(self.reader)
 
     def read(self):
         while(True):
             try:
-                row = next(self.reader)
+                row = self.next_row()
             except StopIteration as e:
                 return None
-            try:
-                mlt = MultiLabelText(row[self.label_start - 1])
-            except Exception as e:
-                raise('Failed to read the text: {}'.format(e))
-            if self.has_id:
-                idstr = row[0]
-            else:
-                idstr = None
-            if idstr:
-                mlt.set_id(idstr)
-            if len(row) <= self.label_start:
-                continue
-            for i, col in enumerate(row[self.label_start:]):
-                if i >= len(self.labels):
-                    raise YamconvError(
-                        'Column {} does not contain any label in the header row: {}'.format())
-                if col == '1':
-                    mlt.add_label(self.labels[i])
-            break
+            mlt = self.parse_row(row)
+            if mlt:
+                return mlt
+
+    def read_chunks(self):
+        while True:
+            rows = list(islice(self.reader, CHUNK_ROWS))
+            if not rows:
+                break
+            yield rows
+
+    def read_record(self):
+        # The blank lines are not indexed as records, so they are skipped
+        # without taking the place of a record in a partition.
+        try:
+            row = self.next_row()
+            while not row:
+                row = self.next_row()
+        except StopIteration as e:
+            return None
+        return self.parse_row(row)
+
+    def parse_row(self, row):
+        if len(row) <= self.label_start:
+            return None
+        check_decoded(''.join(row), row)
+        try:
+            mlt = MultiLabelText(row[self.label_start - 1])
+        except Exception as e:
+            raise RecordError('Failed to read the text: {}'.format(e), row)
+        if self.has_id:
+            idstr = row[0]
+        else:
+            idstr = None
+        if idstr:
+            mlt.set_id(idstr)
+        cols = row[self.label_start:]
+        if len(cols) > len(self.labels):
+            raise RecordError(
+                'Column {} does not contain any label in the header row: {}'
+                .format(self.label_start + len(self.labels) + 1,
+                        cols[len(self.labels):]), row)
+        # The label columns are found by list.index, which scans the cells
+        # in C instead of comparing each of them in Python.
+        labels = []
+        i = -1
+        try:
+            while True:
+                i = cols.index(ONE, i + 1)
+                labels.append(self.labels[i])
+        except ValueError:
+            pass
+        mlt.labels.update(labels)
         return mlt
 
+    def seek_offset(self, offset):
+        self.csv_file.seek(offset)
+
     def close(self):
         self.csv_file.close()
+        self.close_index()
+
+    def __getstate__(self):
+        # Open files are not passed to the worker processes.
+        state = self.__dict__.copy()
+        for key in ['csv_file', 'reader', 'index']:
+            state.pop(key, None)
+        return state
 
 
 class CSVWriter(Writer):
     def __init__(self, out_path, reader, formatter):
         self.reader = reader
         self.formatter = formatter
+        self.append = False
         super(self.__class__, self).__init__(out_path)
 
+    def set_follow(self, append):
+        self.append = append
+        return True
+
     def open(self):
         try:
             self.labels = [self.formatter.format_label(
@@ -92,35 +195,91 @@ class CSVWriter(Writer):
         if not self.labels:
             raise YamconvError(
                 'No labels are given by reader {}'.format(self.reader.__class__.__name__))
-        self.out_file = open(self.filepath, 'w', newline='')
+        # Each label is mapped to its columns, so that a row is built from
+        # the labels of the record rather than from all labels.
+        self.columns = {}
+        for i, label in enumerate(self.labels):
+            self.columns.setdefault(label, []).append(i)
+        self.zeros = [0] * len(self.labels)
+        self.first_row = True
+        if self.append:
+            # The header row has been written to the existing file.
+            with open(self.filepath, 'r', newline='') as f:
+                header = next(csv.reader(f), None)
+            if header:
+                self.has_id = header[0] == 'id'
+                self.first_row = False
+        self.out_file = open(
+            self.filepath, 'a' if self.append else 'w', newline='')
         self.csv_writer = csv.writer(
             self.out_file, delimiter=',', quotechar='"',
             quoting=csv.QUOTE_NONNUMERIC)
-        self.first_row = True
+
+    def write_header(self, has_id):
+        self.has_id = has_id
+        if has_id:
+            row = ['id', 'text']
+        else:
+            row = ['text']
+        for label in self.labels:
+            row.append(label)
+        self.csv_writer.writerow(row)
+        self.first_row = False
 
     def write(self, mlt):
         if self.first_row:
-            if mlt.idstr:
-                self.has_id = True
-                row = ['id', 'text']
-            else:
-                self.has_id = False
-                row = ['text']
-            for label in self.labels:
-                row.append(label)
-            self.csv_writer.writerow(row)
-            self.first_row = False
+            self.write_header(bool(mlt.idstr))
         if self.has_id:
             row = [mlt.idstr]
         else:
             row = []
         row.append(mlt.text)
-        for label in self.labels:
-            if label in mlt.labels:
-                row.append(1)
-            else:
-                row.append(0)
+        start = len(row)
+        row.extend(self.zeros)
+        for label in mlt.labels:
+            for i in self.columns.get(label, ()):
+                row[start + i] = 1
         self.csv_writer.writerow(row)
 
+    def set_passthrough(self, reader, from_formatter):
+        if not isinstance(reader, CSVReader):
+            return False
+        # The output columns of each label column of the input
+        self.input_columns = [self.columns.get(self.formatter.format_label(
+            from_formatter.format_label(l)), ()) for l in reader.labels]
+        return True
+
+    def write_chunk(self, rows):
+        start = self.reader.label_start
+        out_rows = []
+        for row in rows:
+            if len(row) <= start:
+                continue
+            cols = row[start:]
+            if len(cols) > len(self.input_columns):
+                raise YamconvError(
+                    'Row has {} label columns but the header row has {} '
+                    'labels'.format(len(cols), len(self.input_columns)))
+            idstr = row[0] if self.reader.has_id else None
+            if self.first_row:
+                self.write_header(bool(idstr))
+            if self.has_id:
+                out_row = [idstr or None]
+            else:
+                out_row = []
+            out_row.append(' '.join(row[start - 1].split()))
+            start_label = len(out_row)
+            out_row.extend(self.zeros)
+            for columns in compress(
+                    self.input_columns, map(ONE.__eq__, cols)):
+                for i in columns:
+                    out_row[start_label + i] = 1
+            out_rows.append(out_row)
+        self.csv_writer.writerows(out_rows)
+        return len(out_rows)
+
+    def flush(self):
+        self.out_file.flush()
+
     def close(self):
         self.out_file.close()
@@ -0,0 +1,61 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the writer of the same records to several outputs.
+>>> import os, tempfile
+>>> from mlt.mlt import MultiLabelText
+>>> from mlt.fasttext import FastTextWriter
+>>> from mlt.formatter import ToFastText
+>>> tmp_dir = tempfile.mkdtemp()
+>>> paths = [os.path.join(tmp_dir, name) for name in ['a.txt', 'b.txt']]
+>>> writer = FanOutWriter([
+...     (FastTextWriter(paths[0]), ToFastText(True, False)),
+...     (FastTextWriter(paths[1]), ToFastText(False, True))])
+>>> writer.open()
+>>> mlt = MultiLabelText('Hello, World!')
+>>> mlt.add_label('A B')
+>>> writer.write(mlt)
+>>> writer.close()
+>>> [open(path).read() for path in paths]
+['__label__a_b Hello, World!\\n', '__label__A_B hello world\\n']
+"""
+
+from mlt.mlt import Writer
+
+
+class FanOutWriter(Writer):
+    def __init__(self, outputs):
+        # Each output is a pair of a writer and its formatter.
+        self.outputs = outputs
+        super(self.__class__, self).__init__(outputs[0][0].filepath)
+
+    def open(self):
+        for writer, _ in self.outputs:
+            writer.open()
+
+    def write(self, mlt):
+        for writer, formatter in self.outputs:
+            writer.write(formatter.format(mlt))
+
+    def set_follow(self, append):
+        return all([writer.set_follow(append) for writer, _ in self.outputs])
+
+    def flush(self):
+        for writer, _ in self.outputs:
+            writer.flush()
+
+    def close(self):
+        for writer, _ in self.outputs:
+            writer.close()
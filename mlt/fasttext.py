@@ -14,11 +14,38 @@
 # limitations under the License.
 
 import os
-from mlt.mlt import MultiLabelText, Reader, Writer
+from mlt.mlt import MultiLabelText, Writer
+from mlt.index import IndexedReader, check_decoded
 from common.ex import YamconvError
 
+LABEL_PREFIX = '__label__'
+# The size in characters of the lines read in a chunk
+CHUNK_SIZE = 1024 * 1024
 
-class FastTextReader(Reader):
+
+def passthrough_line(line):
+    """Formats a line as it is read and written without normalization,
+    where the labels are moved before the words.
+    >>> passthrough_line('__label__a  __label__b hello \\t world\\n')
+    '__label__a __label__b hello world'
+    >>> passthrough_line('hello __label__a world __label__a\\n')
+    '__label__a hello world'
+    >>> passthrough_line('__label__a\\n')
+    '__label__a '
+    """
+    tokens = line.split()
+    n = line.count(LABEL_PREFIX)
+    if n < len(tokens) and len(set(tokens[:n])) == n and \
+            all(t.startswith(LABEL_PREFIX) for t in tokens[:n]):
+        # The labels are unique and come first, as in most lines.
+        return ' '.join(tokens)
+    labels = list(dict.fromkeys(
+        t for t in tokens if t.startswith(LABEL_PREFIX)))
+    words = [t for t in tokens if not t.startswith(LABEL_PREFIX)]
+    return ' '.join(labels + [' '.join(words)])
+
+
+class FastTextReader(IndexedReader):
     def __init__(self, fasttext_path):
         super(self.__class__, self).__init__(fasttext_path)
 
@@ -26,12 +53,38 @@ class FastTextReader(Reader):
         if not os.path.isfile(self.filepath):
             raise YamconvError(
                 'Input file {} does not exists.'.format(self.filepath))
-        self.fasttext_file = open(self.filepath, 'r')
+        self.fasttext_file = open(
+            self.filepath, 'r', errors='surrogateescape')
+        self.line = 0
+        self.open_index()
+        if self.follow and self.follow_offset:
+            self.seek_offset(self.follow_offset)
+
+    def data_file(self):
+        return self.fasttext_file
+
+    def seek_offset(self, offset):
+        self.fasttext_file.seek(offset)
+
+    def read_record(self):
+        return self.read()
+
+    def read_chunks(self):
+        while True:
+            lines = self.fasttext_file.readlines(CHUNK_SIZE)
+            if not lines:
+                break
+            yield lines
 
     def read(self):
-        line = self.fasttext_file.readline()
+        if self.follow:
+            line = self.follow_lines()[0]
+        else:
+            line = self.fasttext_file.readline()
         if line == '':
             return None
+        self.line += 1
+        check_decoded(line, line)
         tokens = line.split()
         words = set()
         mlt = MultiLabelText()
@@ -49,17 +102,41 @@ class FastTextReader(Reader):
 
     def close(self):
         self.fasttext_file.close()
+        self.close_index()
+
+    def __getstate__(self):
+        # Open files are not passed to the worker processes.
+        state = self.__dict__.copy()
+        for key in ['fasttext_file', 'index']:
+            state.pop(key, None)
+        return state
 
 
 class FastTextWriter(Writer):
     def __init__(self, fasttext_path):
+        self.append = False
         super(self.__class__, self).__init__(fasttext_path)
 
+    def set_follow(self, append):
+        self.append = append
+        return True
+
     def open(self):
-        self.fasttext_file = open(self.filepath, 'w')
+        self.fasttext_file = open(self.filepath, 'a' if self.append else 'w')
 
     def write(self, mlt):
         print(' '.join(list(mlt.labels) + [mlt.text]), file=self.fasttext_file)
 
+    def set_passthrough(self, reader, from_formatter):
+        return isinstance(reader, FastTextReader)
+
+    def write_chunk(self, lines):
+        self.fasttext_file.write(
+            ''.join([passthrough_line(line) + '\n' for line in lines]))
+        return len(lines)
+
+    def flush(self):
+        self.fasttext_file.flush()
+
     def close(self):
         self.fasttext_file.close()
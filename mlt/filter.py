@@ -0,0 +1,114 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the filter to select a subset of records and labels.
+>>> from mlt.mlt import MultiLabelText
+>>> def mlt(*labels):
+...     m = MultiLabelText('some text')
+...     for lab in labels:
+...         m.add_label(lab)
+...     return m
+>>> f = RecordFilter(include_labels=['a', 'b'], exclude_labels=['b'])
+>>> f.apply(mlt('a', 'b', 'c')).labels == {'a'}
+True
+>>> f.apply(mlt('b', 'c')) is None
+True
+>>> f = RecordFilter(min_label_count=2, min_labels=1)
+>>> for m in [mlt('a', 'b'), mlt('a'), mlt('c')]:
+...     f.count(m)
+>>> f.apply(mlt('a', 'b')).labels == {'a'}
+True
+>>> f.apply(mlt('c')) is None
+True
+>>> f = RecordFilter(match='Some, TEXT')
+>>> f.apply(mlt('a')).text
+'some text'
+>>> f.apply(MultiLabelText('text some')) is None
+True
+"""
+
+from common.prepro import normalize_text
+from mlt.mlt import MultiLabelText
+
+
+class RecordFilter:
+    """Selects the records and labels to be converted. Labels are matched in
+    their unformatted form, e.g., without the `__label__` prefix of fastText.
+    - `include_labels`: only these labels are kept, and records left without
+      any label are skipped.
+    - `exclude_labels`: these labels are removed.
+    - `min_label_count`: labels occurring in fewer records are removed.
+    - `min_labels`: records left with fewer labels are skipped.
+    - `limit`: the maximum number of records to be converted.
+    - `match`: only the records whose texts contain this phrase are kept.
+      The phrase and the texts are compared as sequences of words normalized
+      like `word_seq`."""
+
+    def __init__(self, include_labels=None, exclude_labels=None,
+                 min_label_count=None, min_labels=None, limit=None,
+                 match=None):
+        self.include_labels = set(include_labels) \
+            if include_labels is not None else None
+        self.exclude_labels = set(exclude_labels or [])
+        self.min_label_count = min_label_count
+        self.min_labels = min_labels
+        self.limit = limit
+        self.match = normalize_text(match, True) if match else None
+        self.label_counts = {}
+
+    def required_labels(self):
+        if self.min_labels:
+            return self.min_labels
+        if self.include_labels is not None:
+            return 1
+        return 0
+
+    def filters_labels(self):
+        return self.include_labels is not None or \
+            bool(self.exclude_labels) or bool(self.min_label_count)
+
+    def count(self, mlt):
+        for label in mlt.labels:
+            self.label_counts[label] = self.label_counts.get(label, 0) + 1
+
+    def keep_label(self, label):
+        if self.include_labels is not None and \
+                label not in self.include_labels:
+            return False
+        if label in self.exclude_labels:
+            return False
+        if self.min_label_count and \
+                self.label_counts.get(label, 0) < self.min_label_count:
+            return False
+        return True
+
+    def match_phrase(self):
+        """Returns the match phrase as an FTS5 query."""
+        return '"{}"'.format(self.match.replace('"', '""'))
+
+    def apply(self, mlt):
+        if self.match and ' {} '.format(self.match) not in \
+                ' {} '.format(normalize_text(mlt.text, True)):
+            return None
+        if self.filters_labels():
+            labels = [lab for lab in mlt.labels if self.keep_label(lab)]
+            if len(labels) != len(mlt.labels):
+                sub_mlt = MultiLabelText(mlt.text, mlt.idstr)
+                for lab in labels:
+                    sub_mlt.add_label(lab)
+                mlt = sub_mlt
+        if len(mlt.labels) < self.required_labels():
+            return None
+        return mlt
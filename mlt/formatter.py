@@ -73,11 +73,39 @@ from common.prepro import normalize_label, normalize_text
 from mlt.mlt import MultiLabelText
 
 
+# The label caches shared by the formatters of the same kind, which are kept
+# across conversions when enabled by share_label_caches()
+shared_label_caches = None
+
+
+def share_label_caches():
+    global shared_label_caches
+    if shared_label_caches is None:
+        shared_label_caches = {}
+
+
 class Formatter:
     def __init__(self, cache_labels=False):
         self.cache_labels = cache_labels
+        self.cache_size = None
         if cache_labels:
-            self.cached_labels = {}
+            if shared_label_caches is not None:
+                self.cached_labels = shared_label_caches.setdefault(
+                    self.cache_key(), {})
+            else:
+                self.cached_labels = {}
+
+    def cache_key(self):
+        return (self.__class__.__name__,
+                getattr(self, 'normalize_labels', None))
+
+    def set_cache_size(self, cache_size):
+        # The cache is cleared when it reaches cache_size labels.
+        self.cache_size = cache_size
+
+    def clear_cache(self):
+        if self.cache_labels:
+            self.cached_labels.clear()
 
     def format_label(self, label):
         return label
@@ -92,7 +120,10 @@ class Formatter:
                 can_lab = self.cached_labels.get(lab)
                 if not can_lab:
                     can_lab = self.format_label(lab)
-                self.cached_labels[lab] = can_lab
+                    if self.cache_size and \
+                            len(self.cached_labels) >= self.cache_size:
+                        self.cached_labels.clear()
+                    self.cached_labels[lab] = can_lab
             else:
                 can_lab = self.format_label(lab)
             for_mlt.add_label(can_lab)
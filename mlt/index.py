@@ -0,0 +1,306 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the index of the record offsets in a text file.
+>>> import os, tempfile
+>>> d = tempfile.mkdtemp()
+>>> path = os.path.join(d, 'data.csv')
+>>> with open(path, 'w', newline='') as f:
+...     _ = f.write('id,text,a\\n1,"two\\nlines",1\\n2,"a ""b"" c",0\\n')
+>>> offsets = build_offsets(path, is_csv=True)
+>>> list(offsets)
+[10, 26]
+>>> save_index(path, offsets, path + INDEX_SUFFIX)
+>>> index = load_index(path)
+>>> index.count, index.offset(1)
+(2, 26)
+>>> index.close()
+"""
+
+import os
+import sys
+import struct
+import time
+import zlib
+from array import array
+from common.ex import YamconvError, RecordError
+from mlt.mlt import Reader
+
+INDEX_SUFFIX = '.idx'
+MAGIC = b'YAMIDX01'
+# Magic, file size, number of records and checksum of the file
+HEADER = struct.Struct('<8sQQI')
+CHECKSUM_BYTES = 65536
+
+
+def checksum(path):
+    """Computes the checksum of the head and the tail of a file, which is
+    used to detect a stale index."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        crc = zlib.crc32(f.read(CHECKSUM_BYTES))
+        if size > CHECKSUM_BYTES:
+            f.seek(max(CHECKSUM_BYTES, size - CHECKSUM_BYTES))
+            crc = zlib.crc32(f.read(), crc)
+    return size, crc
+
+
+def check_decoded(text, record):
+    """Raises RecordError if the text has the bytes that could not be
+    decoded, which are kept as surrogates by the surrogateescape error
+    handler of the input file, so that only their record is malformed.
+    >>> check_decoded('ok 中文', 'ok 中文')
+    >>> check_decoded(b'bad \\xff'.decode('utf-8', 'surrogateescape'), None)
+    Traceback (most recent call last):
+    ...
+    common.ex.RecordError: Failed to decode the text at character 4
+    """
+    try:
+        text.encode('utf-8')
+    except UnicodeEncodeError as e:
+        if isinstance(record, list):
+            record = [escape_undecoded(r) for r in record]
+        elif record is not None:
+            record = escape_undecoded(record)
+        raise RecordError('Failed to decode the text at character {}'.format(
+            e.start), record)
+
+
+def escape_undecoded(text):
+    """Shows the bytes that could not be decoded as escapes.
+    >>> escape_undecoded(b'bad \\xff'.decode('utf-8', 'surrogateescape'))
+    'bad \\\\xff'
+    """
+    return text.encode('utf-8', 'surrogateescape').decode(
+        'utf-8', 'backslashreplace')
+
+
+def ends_in_quotes(line, in_quotes=False):
+    """Returns whether a CSV line ends within a quoted field, given whether it
+    starts within one. As in the csv module, a quote only opens a field at
+    the start of the field, and two quotes in a quoted field are an escaped
+    quote. The line is either text or bytes.
+    >>> ends_in_quotes('100,a 5" screen,1,0\\n')
+    False
+    >>> ends_in_quotes('1,"two\\n')
+    True
+    >>> ends_in_quotes(b'lines, ""5"" wide",1,0\\n', True)
+    False
+    >>> ends_in_quotes('"a" "b\\n')
+    False
+    """
+    if isinstance(line, bytes):
+        quote, delimiter = b'"', b','
+    else:
+        quote, delimiter = '"', ','
+    i = 0
+    while True:
+        j = line.find(quote, i)
+        if j < 0:
+            return in_quotes
+        if in_quotes:
+            if line[j + 1:j + 2] == quote:
+                # An escaped quote
+                i = j + 2
+                continue
+            in_quotes = False
+        elif j == 0 or line[j - 1:j] == delimiter:
+            in_quotes = True
+        i = j + 1
+
+
+def build_offsets(path, is_csv=False):
+    """Returns the byte offsets of the records in a fastText file or the data
+    rows in a CSV file. A line break within a quoted CSV field does not start
+    a new record, while a quote within an unquoted field is kept as it is.
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'data.csv')
+    >>> with open(path, 'wb') as f:
+    ...     _ = f.write(b'id,text,a\\n1,a 5" screen,1\\n'
+    ...                 b'2,"b\\nc",0\\n3,d,1\\n')
+    >>> list(build_offsets(path, is_csv=True))
+    [10, 26, 36]
+    """
+    offsets = array('Q')
+    pos = 0
+    in_quotes = False
+    with open(path, 'rb') as f:
+        for line in f:
+            if not in_quotes:
+                if not is_csv or line.strip(b'\r\n'):
+                    offsets.append(pos)
+            if is_csv:
+                in_quotes = ends_in_quotes(line, in_quotes)
+            pos += len(line)
+    if is_csv and offsets:
+        # The header row is not a record
+        offsets.pop(0)
+    return offsets
+
+
+def save_index(path, offsets, index_path):
+    size, crc = checksum(path)
+    if sys.byteorder != 'little':
+        offsets = array('Q', offsets)
+        offsets.byteswap()
+    with open(index_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, size, len(offsets), crc))
+        offsets.tofile(f)
+
+
+class RecordIndex:
+    def __init__(self, index_path, count):
+        self.index_file = open(index_path, 'rb')
+        self.count = count
+
+    def offset(self, i):
+        if i < 0 or i >= self.count:
+            raise YamconvError('Record {} is out of range'.format(i))
+        self.index_file.seek(HEADER.size + 8 * i)
+        return struct.unpack('<Q', self.index_file.read(8))[0]
+
+    def close(self):
+        self.index_file.close()
+
+
+def load_index(path):
+    """Returns the index of a file if it exists and matches the file, or
+    otherwise None."""
+    index_path = path + INDEX_SUFFIX
+    if not os.path.isfile(index_path):
+        return None
+    with open(index_path, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) != HEADER.size:
+        return None
+    magic, size, count, crc = HEADER.unpack(header)
+    if magic != MAGIC or (size, crc) != checksum(path):
+        return None
+    return RecordIndex(index_path, count)
+
+
+class Indexer:
+    def __init__(self, in_path, index_path, is_csv=False, logger=None):
+        self.in_path = in_path
+        self.index_path = index_path
+        self.is_csv = is_csv
+        self.logger = logger
+
+    def convert(self):
+        if not os.path.isfile(self.in_path):
+            raise YamconvError(
+                'Input file {} does not exists.'.format(self.in_path))
+        try:
+            offsets = build_offsets(self.in_path, self.is_csv)
+            save_index(self.in_path, offsets, self.index_path)
+        except Exception as e:
+            msg = 'Error indexing input file {}: {}'.format(self.in_path, e)
+            if self.logger:
+                self.logger.error(msg)
+            raise YamconvError(msg)
+        if self.logger:
+            self.logger.info('Indexed {} records of {} in {}.'.format(
+                len(offsets), self.in_path, self.index_path))
+
+
+class IndexedReader(Reader):
+    """A reader of a text file that uses the index of the file, if any, to
+    count, seek and partition the records. In the follow mode, it waits for
+    the records appended to the file at the end of the file."""
+    follow = False
+
+    def set_follow(self, poll_interval, on_idle=None, offset=0):
+        self.follow = True
+        self.poll_interval = poll_interval
+        self.on_idle = on_idle
+        self.follow_offset = offset
+        self.follow_line = 0
+        return True
+
+    def record_complete(self, lines):
+        return True
+
+    def follow_lines(self):
+        """Returns the lines of the next complete record. A partial record at
+        the end of the file is read again when more data is appended, and
+        on_idle is called when the reader starts waiting."""
+        f = self.data_file()
+        idle = False
+        while True:
+            offset = f.tell()
+            lines = []
+            try:
+                while True:
+                    line = f.readline()
+                    if not line.endswith('\n'):
+                        break
+                    lines.append(line)
+                    if self.record_complete(lines):
+                        self.follow_line += len(lines)
+                        return lines
+            except KeyboardInterrupt:
+                # The offset is kept at the start of the record.
+                f.seek(offset)
+                raise
+            f.seek(offset)
+            if not idle and self.on_idle:
+                self.on_idle()
+            idle = True
+            time.sleep(self.poll_interval)
+
+    def offset(self):
+        return self.data_file().tell()
+
+    def position(self):
+        # The line of the last record read, counted from the offset where
+        # the reader started in the follow mode.
+        return self.line
+
+    def open_index(self):
+        self.index = load_index(self.filepath)
+
+    def close_index(self):
+        if self.index:
+            self.index.close()
+
+    def count(self):
+        if not self.index:
+            return None
+        return self.index.count
+
+    def seek(self, i):
+        if not self.index:
+            raise YamconvError(
+                'Input file {} is not indexed.'.format(self.filepath))
+        self.seek_offset(self.index.offset(i))
+
+    def partitions(self, size):
+        if not self.index:
+            return None
+        return [(lo, min(lo + size, self.index.count) - 1)
+                for lo in range(0, self.index.count, size)]
+
+    def open_readonly(self):
+        self.open()
+
+    def read_partition(self, partition):
+        first, last = partition
+        self.seek(first)
+        mlts = []
+        for _ in range(last - first + 1):
+            mlt = self.read_record()
+            if mlt:
+                mlts.append(mlt)
+        return mlts
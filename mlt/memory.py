@@ -0,0 +1,69 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the memory budget of a conversion.
+>>> budget = MemoryBudget(1024 * 1024 * 1024)
+>>> budget.spill_memory
+536870912
+>>> budget.queue_depth(10000)
+7
+>>> budget.rss() > 0
+True
+"""
+
+import os
+
+# The approximate memory used by a cached label and by a record
+LABEL_BYTES = 256
+RECORD_BYTES = 2048
+# Back-pressure is applied when the RSS exceeds this fraction of the limit
+HIGH_WATERMARK = 0.9
+
+
+class MemoryBudget:
+    """Divides a memory limit in bytes among the label caches, the batches
+    of records read from the input, the queue of records formatted by the
+    workers, and the records held by shuffling or sorting before they are
+    spilled to disk. The rest is left for the interpreter and the writer."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.label_cache_size = max(1000, limit // 10 // 2 // LABEL_BYTES)
+        self.batch_size = max(100, min(10000, limit // 20 // RECORD_BYTES))
+        self.queue_memory = limit * 3 // 20
+        self.spill_memory = limit // 2
+        self.last_rss = 0
+
+    def queue_depth(self, partition_size):
+        return max(1, self.queue_memory // (partition_size * RECORD_BYTES))
+
+    def rss(self):
+        try:
+            with open('/proc/self/statm') as f:
+                pages = int(f.read().split()[1])
+            self.last_rss = pages * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            # The peak RSS is used where the current RSS is not available.
+            import resource
+            self.last_rss = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024
+        return self.last_rss
+
+    def under_pressure(self):
+        return self.rss() > self.limit * HIGH_WATERMARK
+
+    def usage(self):
+        return 'RSS {} MB of {} MB'.format(
+            self.last_rss // (1024 * 1024), self.limit // (1024 * 1024))
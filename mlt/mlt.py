@@ -14,9 +14,21 @@
 # limitations under the License.
 
 from uuid import uuid4
-from common.ex import YamconvError
+from common.ex import YamconvError, RecordError
 from abc import ABC
 import logging
+import os
+import json
+import shutil
+import signal
+import tempfile
+from contextlib import contextmanager
+from itertools import islice
+from mlt.parallel import parallel_records, parallel_load
+
+STATS_SUFFIX = '.stats.json'
+FOLLOW_SUFFIX = '.follow'
+QUARANTINE_SUFFIX = '.quarantine.jsonl'
 
 
 def gen_id():
@@ -44,68 +56,539 @@ class MultiLabelText:
 
 class Converter:
     def __init__(self, reader, from_formatter, writer, to_formatter,
-                 logger=None, nlines=1000):
+                 logger=None, nlines=1000, stats=None,
+                 record_filter=None, workers=1, partition_size=10000,
+                 shuffler=None, sorter=None, memory_budget=None,
+                 text_compression=None, compression_dict=False,
+                 follow=False, poll_interval=1, fts_index=False,
+                 passthrough=False, parallel_load=False, analyze=False,
+                 vacuum=False, max_errors=None, quarantine=None):
         self.reader = reader
         self.from_formatter = from_formatter
         self.writer = writer
         self.to_formatter = to_formatter
         self.logger = logger
         self.nlines = nlines
+        self.stats = stats
+        self.record_filter = record_filter
+        self.workers = workers
+        self.partition_size = partition_size
+        self.shuffler = shuffler
+        self.sorter = sorter
+        self.memory_budget = memory_budget
+        self.text_compression = text_compression
+        self.compression_dict = compression_dict
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.fts_index = fts_index
+        self.passthrough = passthrough
+        self.parallel_load = parallel_load
+        self.analyze = analyze
+        self.vacuum = vacuum
+        self.max_errors = max_errors
+        self.quarantine = quarantine
+        self.quarantine_file = None
+        self.errors = 0
+        self.records_read = 0
+        self.position = 0
+        self.counting = False
+        self.deferring = False
+        self.interrupted = False
 
     def info(self, msg):
         if self.logger:
             self.logger.info(msg)
 
+    def warn(self, msg):
+        if self.logger:
+            self.logger.warning(msg)
+
     def err(self, msg):
         if self.logger:
             self.logger.error(msg)
         raise YamconvError(msg)
 
     def convert(self):
-        try:
-            self.reader.open()
-        except Exception as e:
-            self.err('Error opening input file {}: {}'.format(
-                self.reader.filepath, e))
-        self.info('Opened input file {}.'.format(self.reader.filepath))
+        if self.memory_budget:
+            self.apply_memory_budget()
+        if self.text_compression and not self.writer.set_compression(
+                self.text_compression, self.compression_dict):
+            self.err('Output file {} does not support text compression.'
+                     .format(self.writer.filepath))
+        if self.fts_index and not self.writer.set_fts_index():
+            self.err('Output file {} does not support full-text index.'
+                     .format(self.writer.filepath))
+        if self.parallel_load:
+            self.start_parallel_load()
+        if self.follow:
+            self.start_follow()
+        pushed_down = False
+        if self.record_filter:
+            pushed_down = self.reader.set_filter(self.record_filter)
+            if not pushed_down and self.record_filter.min_label_count:
+                self.count_labels()
+        self.open_reader()
         try:
             self.writer.open()
         except Exception as e:
             self.err('Error opening output file {}: {}'.format(
                 self.writer.filepath, e))
         self.info('Opened output file {}.'.format(self.writer.filepath))
+        if self.parallel_load:
+            i = self.load_parallel(pushed_down)
+        elif self.can_copy():
+            i = self.copy()
+        else:
+            i = self.write_records(pushed_down)
+        self.info('Completed processing {} records in total.'.format(i))
+        if self.quarantine_file:
+            self.quarantine_file.close()
+            self.warn('Skipped {} malformed records, which are saved in '
+                      'quarantine file {}.'.format(
+                          self.errors, self.quarantine))
+        self.close_reader()
+        try:
+            self.writer.close()
+        except Exception as e:
+            self.err('Error closing output file {}: {}'.format(
+                self.writer.filepath, e))
+        self.info('Closed output file {}.'.format(self.writer.filepath))
+        if self.stats:
+            stats_path = self.writer.filepath + STATS_SUFFIX
+            try:
+                self.stats.save(stats_path)
+            except Exception as e:
+                self.err('Error writing statistics file {}: {}'.format(
+                    stats_path, e))
+            self.info('Saved statistics file {}.'.format(stats_path))
+        return i
+
+    def write_records(self, pushed_down):
+        source = None
+        if self.workers > 1 and self.max_errors:
+            self.info('The records are read by one process to skip the '
+                      'malformed ones.')
+        elif self.workers > 1 and not self.follow and \
+                (pushed_down or not self.record_filter):
+            source = self.parallel_records()
+        if source is None:
+            source = self.records(pushed_down)
+        records = source
+        if self.memory_budget:
+            records = self.monitor(records)
+        if self.record_filter and self.record_filter.limit:
+            records = islice(records, self.record_filter.limit)
+        if self.shuffler:
+            self.info('Shuffling the records.')
+            records = self.guard(
+                self.shuffler.shuffle(records),
+                'Error shuffling the records')
+        if self.sorter:
+            self.info('Sorting the records.')
+            records = self.guard(
+                self.sorter.sort(records),
+                'Error sorting the records')
+        total = None
+        if not self.record_filter:
+            total = self.reader.count()
         i = 0
-        while True:
+        if self.follow:
+            handlers = self.defer_interrupts()
+            self.written_offset = self.reader.offset()
+        try:
+            for to_mlt in records:
+                try:
+                    if self.follow:
+                        with self.uninterrupted():
+                            self.writer.write(to_mlt)
+                            self.written_offset = self.reader.offset()
+                    else:
+                        self.writer.write(to_mlt)
+                except Exception as e:
+                    self.skip(e, 'write', i + 1, to_mlt,
+                              'Error writing output file {}: {}'.format(
+                                  self.writer.filepath, e))
+                    continue
+                if self.stats:
+                    self.stats.add(to_mlt)
+                i += 1
+                if i % self.nlines == 0:
+                    if total:
+                        msg = 'Processed {} of {} records'.format(i, total)
+                    else:
+                        msg = 'Processed {} records'.format(i)
+                    if self.memory_budget:
+                        msg += ' ({})'.format(self.memory_budget.usage())
+                    self.info(msg + '.')
+                    if self.follow:
+                        self.checkpoint(self.written_offset)
+        except KeyboardInterrupt:
+            if not self.follow:
+                raise
+            self.info('Stopped following input file {}.'.format(
+                self.reader.filepath))
+        if self.follow:
+            # A record read but not written yet is read again on restart.
+            self.checkpoint(self.written_offset)
+            self.restore_interrupts(handlers)
+        source.close()
+        return i
+
+    def can_copy(self):
+        # The records are copied as they are read only when no feature
+        # needs them to be formatted one by one.
+        if not self.passthrough or self.record_filter or self.stats or \
+                self.shuffler or self.sorter or self.follow or \
+                self.text_compression or self.fts_index or self.max_errors:
+            return False
+        return self.writer.set_passthrough(self.reader, self.from_formatter)
+
+    def copy(self):
+        self.info('Copying the records in chunks.')
+        total = self.reader.count()
+        i = 0
+        chunks = self.guard(
+            self.reader.read_chunks(),
+            'Error reading input file {}'.format(self.reader.filepath))
+        for chunk in chunks:
             try:
-                from_mlt = self.reader.read()
+                n = self.writer.write_chunk(chunk)
             except Exception as e:
-                self.err('Error reading input file {}: {}'.format(
-                    self.reader.filepath, e))
-            if not from_mlt:
+                self.err('Error writing output file {}: {}'.format(
+                    self.writer.filepath, e))
+            if (i + n) // self.nlines > i // self.nlines:
+                if total:
+                    self.info('Processed {} of {} records.'.format(
+                        i + n, total))
+                else:
+                    self.info('Processed {} records.'.format(i + n))
+            i += n
+        return i
+
+    def start_parallel_load(self):
+        if self.workers < 2:
+            self.err('The parallel load needs more than one worker.')
+        if self.shuffler or self.sorter or self.follow or self.stats or \
+                self.compression_dict or self.max_errors or \
+                (self.record_filter and self.record_filter.limit):
+            self.err('The parallel load cannot be used with shuffle, '
+                     'sort_by, stats, limit, compression_dict, max_errors '
+                     'or the follow mode.')
+        if not self.writer.set_bulk_load(self.analyze, self.vacuum):
+            self.err('Output file {} does not support parallel load.'
+                     .format(self.writer.filepath))
+
+    def load_parallel(self, pushed_down):
+        # Each worker loads its partitions into temporary databases next to
+        # the output, which are merged into the output in order.
+        if self.record_filter and not pushed_down:
+            self.err('The parallel load needs the filters to be applied by '
+                     'input file {}.'.format(self.reader.filepath))
+        try:
+            partitions = self.reader.partitions(self.partition_size)
+        except Exception as e:
+            self.err('Error partitioning input file {}: {}'.format(
+                self.reader.filepath, e))
+        if partitions is None:
+            self.err('Input file {} cannot be read in parallel.'.format(
+                self.reader.filepath))
+        self.info('Loading {} partitions with {} workers.'.format(
+            len(partitions), self.workers))
+        total = None
+        if not self.record_filter:
+            total = self.reader.count()
+        part_dir = tempfile.mkdtemp(
+            prefix=os.path.basename(self.writer.filepath) + '.',
+            dir=os.path.dirname(os.path.abspath(self.writer.filepath)))
+        i = 0
+        try:
+            for part_path, count in self.guard(
+                    parallel_load(
+                        self.reader, self.from_formatter, self.to_formatter,
+                        self.writer, partitions, self.workers, part_dir),
+                    'Error loading input file {}'.format(
+                        self.reader.filepath)):
+                try:
+                    self.writer.merge_part(part_path, i)
+                except Exception as e:
+                    self.err('Error merging into output file {}: {}'.format(
+                        self.writer.filepath, e))
+                os.remove(part_path)
+                if (i + count) // self.nlines > i // self.nlines:
+                    if total:
+                        self.info('Processed {} of {} records.'.format(
+                            i + count, total))
+                    else:
+                        self.info('Processed {} records.'.format(i + count))
+                i += count
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+        return i
+
+    def records(self, pushed_down=False):
+        while True:
+            norm_mlt = self.read_formatted()
+            if not norm_mlt:
                 break
-            norm_mlt = self.from_formatter.format(from_mlt)
-            to_mlt = self.to_formatter.format(norm_mlt)
+            if self.record_filter and not pushed_down:
+                norm_mlt = self.record_filter.apply(norm_mlt)
+                if not norm_mlt:
+                    continue
             try:
-                self.writer.write(to_mlt)
+                to_mlt = self.to_formatter.format(norm_mlt)
+            except Exception as e:
+                self.skip(e, 'format', self.position, norm_mlt,
+                          'Error formatting record {}: {}'.format(
+                              self.position, e))
+                continue
+            yield to_mlt
+
+    def start_follow(self):
+        if self.shuffler or self.sorter or (self.record_filter and (
+                self.record_filter.limit or
+                self.record_filter.min_label_count)):
+            self.err('The follow mode cannot be used with shuffle, sort_by, '
+                     'limit or min_label_count.')
+        self.follow_path = self.writer.filepath + FOLLOW_SUFFIX
+        offset = 0
+        if os.path.isfile(self.follow_path):
+            try:
+                with open(self.follow_path) as f:
+                    state = json.load(f)
+            except Exception as e:
+                self.err('Error reading follow state file {}: {}'.format(
+                    self.follow_path, e))
+            if state.get('input') == os.path.abspath(self.reader.filepath):
+                offset = state.get('offset', 0)
+        if not self.reader.set_follow(
+                self.poll_interval, self.checkpoint, offset):
+            self.err('Input file {} cannot be followed.'.format(
+                self.reader.filepath))
+        if not self.writer.set_follow(offset > 0):
+            self.err('Output file {} cannot be appended in follow mode.'
+                     .format(self.writer.filepath))
+        if offset:
+            self.info('Resuming input file {} from offset {}.'.format(
+                self.reader.filepath, offset))
+
+    def checkpoint(self, offset=None):
+        # The records written so far are flushed before their input offset
+        # is saved, so that a restart continues after them.
+        with self.uninterrupted():
+            try:
+                self.writer.flush()
             except Exception as e:
                 self.err('Error writing output file {}: {}'.format(
                     self.writer.filepath, e))
+            if offset is None:
+                offset = self.reader.offset()
+            state = {'input': os.path.abspath(self.reader.filepath),
+                     'offset': offset}
+            try:
+                tmp_path = self.follow_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.follow_path)
+            except Exception as e:
+                self.err('Error writing follow state file {}: {}'.format(
+                    self.follow_path, e))
+
+    def defer_interrupts(self):
+        # Returns the previous handlers, or None if the signals cannot be
+        # handled by this thread.
+        handlers = {}
+        try:
+            for signum in [signal.SIGINT, signal.SIGTERM]:
+                handlers[signum] = signal.signal(signum, self.interrupt)
+        except ValueError:
+            self.restore_interrupts(handlers)
+            return None
+        return handlers
+
+    def restore_interrupts(self, handlers):
+        for signum, handler in (handlers or {}).items():
+            signal.signal(signum, handler)
+
+    def interrupt(self, signum, frame):
+        # An interrupt while a record or a checkpoint is written is raised
+        # when it is done, so that neither is left partial.
+        if self.deferring:
+            self.interrupted = True
+        else:
+            raise KeyboardInterrupt
+
+    @contextmanager
+    def uninterrupted(self):
+        self.deferring = True
+        try:
+            yield
+        finally:
+            self.deferring = False
+        if self.interrupted:
+            self.interrupted = False
+            raise KeyboardInterrupt
+
+    def apply_memory_budget(self):
+        budget = self.memory_budget
+        for formatter in [self.from_formatter, self.to_formatter]:
+            formatter.set_cache_size(budget.label_cache_size)
+        self.reader.set_batch_size(budget.batch_size)
+        self.info(
+            'Memory limit {} MB: {} cached labels, {} records per batch, '
+            '{} partitions in queue.'.format(
+                budget.limit // (1024 * 1024), budget.label_cache_size,
+                budget.batch_size, budget.queue_depth(self.partition_size)))
+
+    def monitor(self, records):
+        # Samples the memory usage and relieves the pressure by clearing
+        # the label caches and spilling the records held in memory.
+        i = 0
+        was_under_pressure = False
+        for mlt in records:
+            yield mlt
             i += 1
-            if i % 1000 == 0:
-                self.info('Processed {} records.'.format(i))
-        self.info('Completed processing {} records in total.'.format(i))
+            if i % self.nlines != 0:
+                continue
+            under_pressure = self.memory_budget.under_pressure()
+            if under_pressure and not was_under_pressure:
+                self.info('Memory under pressure ({}).'.format(
+                    self.memory_budget.usage()))
+            was_under_pressure = under_pressure
+            if under_pressure:
+                self.from_formatter.clear_cache()
+                self.to_formatter.clear_cache()
+                for spiller in [self.shuffler, self.sorter]:
+                    if spiller:
+                        spiller.pressure = True
+
+    def parallel_records(self):
+        try:
+            partitions = self.reader.partitions(self.partition_size)
+        except Exception as e:
+            self.err('Error partitioning input file {}: {}'.format(
+                self.reader.filepath, e))
+        if partitions is None:
+            self.info('Input file {} cannot be read in parallel.'.format(
+                self.reader.filepath))
+            return None
+        self.info('Reading {} partitions with {} workers.'.format(
+            len(partitions), self.workers))
+        return self.guard(
+            parallel_records(
+                self.reader, self.from_formatter, self.to_formatter,
+                partitions, self.workers,
+                queue_depth=self.memory_budget.queue_depth(
+                    self.partition_size) if self.memory_budget else None,
+                budget=self.memory_budget),
+            'Error reading input file {}'.format(self.reader.filepath))
+
+    def guard(self, records, msg):
+        # Reports the errors raised while iterating the records.
+        try:
+            for mlt in records:
+                yield mlt
+        except YamconvError:
+            raise
+        except Exception as e:
+            self.err('{}: {}'.format(msg, e))
+        finally:
+            records.close()
+
+    def read_formatted(self):
+        # Returns None at the end of the input, after skipping the malformed
+        # records if max_errors is set.
+        while True:
+            self.records_read += 1
+            try:
+                from_mlt = self.reader.read()
+            except Exception as e:
+                self.position = self.record_position()
+                self.skip(e, 'read', self.position,
+                          getattr(e, 'record', None),
+                          'Error reading input file {}: {}'.format(
+                              self.reader.filepath, e))
+                continue
+            if not from_mlt:
+                return None
+            self.position = self.record_position()
+            try:
+                return self.from_formatter.format(from_mlt)
+            except Exception as e:
+                self.skip(e, 'format', self.position, from_mlt,
+                          'Error formatting record {}: {}'.format(
+                              self.position, e))
+
+    def record_position(self):
+        # The position of the last record in the input, which is the number
+        # of the records read if the reader does not know it.
+        position = self.reader.position()
+        if position is None:
+            return self.records_read
+        return position
+
+    def skip(self, e, stage, position, record, msg):
+        # Saves a malformed record in the quarantine file, or stops the
+        # conversion without max_errors or beyond it.
+        if not self.max_errors or isinstance(e, YamconvError) and \
+                not isinstance(e, RecordError):
+            self.err(msg)
+        if self.counting:
+            # The records are quarantined in the pass that converts them.
+            return
+        self.errors += 1
+        if self.errors > self.max_errors:
+            self.err('{} (more than {} malformed records)'.format(
+                msg, self.max_errors))
+        if isinstance(record, MultiLabelText):
+            record = {'id': record.idstr, 'text': record.text,
+                      'labels': sorted(record.labels)}
+        entry = {'position': position, 'stage': stage, 'error': str(e),
+                 'record': record}
+        try:
+            if not self.quarantine_file:
+                if not self.quarantine:
+                    self.quarantine = self.writer.filepath + \
+                        QUARANTINE_SUFFIX
+                self.quarantine_file = open(self.quarantine, 'w')
+            print(json.dumps(entry, ensure_ascii=False),
+                  file=self.quarantine_file)
+            self.quarantine_file.flush()
+        except Exception as e:
+            self.err('Error writing quarantine file {}: {}'.format(
+                self.quarantine, e))
+        self.info('Skipped record {}: {}'.format(position, msg))
+
+    def count_labels(self):
+        # The label frequencies require a separate pass over the input
+        # when the reader cannot apply the filter itself.
+        self.open_reader()
+        self.counting = True
+        while True:
+            norm_mlt = self.read_formatted()
+            if not norm_mlt:
+                break
+            self.record_filter.count(norm_mlt)
+        self.counting = False
+        self.records_read = 0
+        self.close_reader()
+        self.info('Counted the frequencies of {} labels.'.format(
+            len(self.record_filter.label_counts)))
+
+    def open_reader(self):
+        try:
+            self.reader.open()
+        except Exception as e:
+            self.err('Error opening input file {}: {}'.format(
+                self.reader.filepath, e))
+        self.info('Opened input file {}.'.format(self.reader.filepath))
+
+    def close_reader(self):
         try:
             self.reader.close()
         except Exception as e:
             self.err('Error closing input file {}: {}'.format(
                 self.reader.filepath, e))
         self.info('Closed input file {}.'.format(self.reader.filepath))
-        try:
-            self.writer.close()
-        except Exception as e:
-            self.err('Error closing output file {}: {}'.format(
-                self.writer.filepath, e))
-        self.info('Closed output file {}.'.format(self.writer.filepath))
 
 
 class Reader(ABC):
@@ -121,6 +604,29 @@ class Reader(ABC):
     def close():
         pass
 
+    def set_filter(self, record_filter):
+        # Returns True if the reader applies the filter by itself.
+        return False
+
+    def partitions(self, size):
+        # Returns None if the input cannot be read in partitions.
+        return None
+
+    def count(self):
+        # Returns None if the number of records is unknown.
+        return None
+
+    def set_batch_size(self, batch_size):
+        pass
+
+    def set_follow(self, poll_interval, on_idle=None, offset=0):
+        # Returns True if the reader supports the follow mode.
+        return False
+
+    def position(self):
+        # Returns None if the position of the last record is unknown.
+        return None
+
 
 class Writer(ABC):
     def __init__(self, filepath):
@@ -134,3 +640,31 @@ class Writer(ABC):
 
     def close():
         pass
+
+    def set_compression(self, compression, train_dict=False):
+        # Returns True if the writer supports text compression.
+        return False
+
+    def set_follow(self, append):
+        # Returns True if the writer supports the follow mode.
+        return False
+
+    def set_fts_index(self):
+        # Returns True if the writer supports full-text index.
+        return False
+
+    def set_bulk_load(self, analyze=False, vacuum=False):
+        # Returns True if the writer can merge the databases loaded by the
+        # workers.
+        return False
+
+    def set_passthrough(self, reader, from_formatter):
+        # Returns True if the writer can copy the chunks of the reader.
+        return False
+
+    def write_chunk(self, chunk):
+        # Returns the number of records written.
+        pass
+
+    def flush(self):
+        pass
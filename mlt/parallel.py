@@ -0,0 +1,136 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains functions to read and format the records of a
+partitioned input in worker processes, and to load them into temporary
+databases."""
+
+import os
+import multiprocessing
+from collections import deque
+
+# The reader and formatters of a worker process
+worker = {}
+# The context the worker pools are started with
+pool_context = multiprocessing.get_context()
+
+
+def set_start_method(method):
+    """Sets the start method of the worker pools, e.g., spawn in a process
+    that runs other threads, whose locks a forked worker might inherit while
+    they are held."""
+    global pool_context
+    pool_context = multiprocessing.get_context(method)
+
+
+def init_worker(reader, from_formatter, to_formatter, writer=None):
+    reader.open_readonly()
+    worker['reader'] = reader
+    worker['from_formatter'] = from_formatter
+    worker['to_formatter'] = to_formatter
+    worker['writer'] = writer
+
+
+def formatted_partition(partition):
+    from_formatter = worker['from_formatter']
+    to_formatter = worker['to_formatter']
+    for mlt in worker['reader'].read_partition(partition):
+        yield to_formatter.format(from_formatter.format(mlt))
+
+
+def format_partition(partition):
+    return list(formatted_partition(partition))
+
+
+def load_partition(task):
+    partition, part_path = task
+    count = worker['writer'].write_part(
+        part_path, formatted_partition(partition))
+    return part_path, count
+
+
+def ordered_results(pool, func, tasks, queue_depth, budget):
+    """Keeps at most `queue_depth` tasks pending, or one while the memory
+    budget is under pressure, and yields their results in order.
+    >>> class Pool:
+    ...     submitted, done, depths = 0, 0, []
+    ...     def apply_async(self, func, args):
+    ...         self.submitted += 1
+    ...         self.depths.append(self.submitted - self.done)
+    ...         return Result(self, func(*args))
+    >>> class Result:
+    ...     def __init__(self, pool, value):
+    ...         self.pool, self.value = pool, value
+    ...     def get(self):
+    ...         self.pool.done += 1
+    ...         return self.value
+    >>> class Budget:
+    ...     samples = [False, True, True, True, True]
+    ...     def under_pressure(self):
+    ...         return self.samples.pop(0) if self.samples else False
+    >>> pool = Pool()
+    >>> list(ordered_results(pool, abs, range(30), 4, Budget())) == \\
+    ...     list(range(30))
+    True
+    >>> pool.depths[-5:]
+    [4, 4, 4, 4, 4]
+    """
+    pending = deque()
+    tasks = iter(tasks)
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task, )))
+        if len(pending) >= queue_depth:
+            break
+    while pending:
+        result = pending.popleft().get()
+        if not (budget and budget.under_pressure() and pending):
+            # The queue is refilled once the pressure is relieved.
+            for task in tasks:
+                pending.append(pool.apply_async(func, (task, )))
+                if len(pending) >= queue_depth or \
+                        (budget and budget.under_pressure()):
+                    break
+        yield result
+
+
+def parallel_records(reader, from_formatter, to_formatter,
+                     partitions, workers, queue_depth=None, budget=None):
+    """Yields the formatted records of the partitions in order. At most
+    `queue_depth` partitions, or two per worker by default, are pending at a
+    time to bound the memory used by the results waiting for the writer. Only
+    one is pending while the memory budget is under pressure."""
+    if not queue_depth:
+        queue_depth = 2 * workers
+    with pool_context.Pool(workers, init_worker,
+              (reader, from_formatter, to_formatter)) as pool:
+        for mlts in ordered_results(
+                pool, format_partition, partitions, queue_depth, budget):
+            for mlt in mlts:
+                yield mlt
+
+
+def parallel_load(reader, from_formatter, to_formatter, writer,
+                  partitions, workers, part_dir):
+    """Loads the formatted records of each partition into a temporary
+    database in `part_dir` by `writer.write_part`, and yields the paths and
+    the numbers of records of the databases in the order of the partitions.
+    Two databases per worker are pending at a time."""
+    tasks = [(partition, os.path.join(part_dir, 'part-{:06d}.db'.format(i)))
+             for i, partition in enumerate(partitions)]
+    with pool_context.Pool(workers, init_worker,
+              (reader, from_formatter, to_formatter, writer)) as pool:
+        for result in ordered_results(
+                pool, load_partition, tasks, 2 * workers, None):
+            yield result
@@ -0,0 +1,211 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains a local conversion service, which runs conversion
+jobs on a pool of threads to avoid the startup cost of a process per job,
+and its client. The service listens on a localhost HTTP port given as
+`host:port`, or on a Unix socket given as `unix:path`."""
+
+import os
+import json
+import stat
+import signal
+import socket
+import ipaddress
+import time
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from common.ex import YamconvError
+from mlt.formatter import share_label_caches
+from mlt.parallel import set_start_method
+
+
+def parse_address(address):
+    """Returns the path of a Unix socket, or the host and port of a loopback
+    address, since the jobs read and write any files of the service.
+    >>> parse_address('unix:/tmp/yamconv.sock')
+    '/tmp/yamconv.sock'
+    >>> parse_address(':8765'), parse_address('localhost:8765')
+    (('127.0.0.1', 8765), ('localhost', 8765))
+    >>> parse_address('0.0.0.0:8765')
+    Traceback (most recent call last):
+    ...
+    common.ex.YamconvError: Address 0.0.0.0:8765 is not a loopback address
+    """
+    if address.startswith('unix:'):
+        return address[len('unix:'):]
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise YamconvError(
+            'Address {} is neither host:port nor unix:path'.format(address))
+    host = host or '127.0.0.1'
+    if host != 'localhost':
+        try:
+            is_loopback = ipaddress.ip_address(host.strip('[]')).is_loopback
+        except ValueError:
+            is_loopback = False
+        if not is_loopback:
+            raise YamconvError(
+                'Address {} is not a loopback address'.format(address))
+    return (host, int(port))
+
+
+def remove_socket(path):
+    # Only a socket left by a previous service is removed, never a file
+    # given by mistake.
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise YamconvError('{} exists and is not a socket'.format(path))
+    os.remove(path)
+
+
+class ConversionService:
+    def __init__(self, converter_factory, workers, logger):
+        self.converter_factory = converter_factory
+        # The jobs run concurrently on threads, so a job with workers starts
+        # its worker processes by spawn rather than by forking the threads.
+        self.executor = ThreadPoolExecutor(workers)
+        self.logger = logger
+        share_label_caches()
+        set_start_method('spawn')
+
+    def run_job(self, job):
+        start = time.time()
+        try:
+            settings = dict(job.get('settings') or {})
+            # The label caches are kept across the jobs by default.
+            settings.setdefault('cache_labels', True)
+            converter = self.converter_factory(
+                job.get('converter'), job.get('input'), job.get('output'),
+                settings)
+            if not converter:
+                raise YamconvError('Unknown converter name {}'.format(
+                    job.get('converter')))
+            records = converter.convert()
+            result = {'status': 'ok', 'records': records}
+            if getattr(converter, 'errors', 0):
+                result['skipped'] = converter.errors
+        except Exception as e:
+            result = {'status': 'error', 'error': str(e)}
+        result['elapsed'] = round(time.time() - start, 6)
+        self.logger.info('Job {} {} -> {}: {} in {:.3f}s.'.format(
+            job.get('converter'), job.get('input'), job.get('output'),
+            result['status'], result['elapsed']))
+        return result
+
+    def submit(self, job):
+        return self.executor.submit(self.run_job, job).result()
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/convert':
+            self.reply(404, {'status': 'error', 'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(job, dict):
+                raise ValueError('job is not a JSON object')
+        except Exception as e:
+            self.reply(400, {'status': 'error',
+                             'error': 'Invalid job: {}'.format(e)})
+            return
+        result = self.server.service.submit(job)
+        self.reply(200, result)
+
+    def reply(self, code, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        self.server.service.logger.debug(format % args)
+
+
+class LocalHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is not available before Python 3.7.
+    daemon_threads = True
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(address, converter_factory, workers, logger):
+    addr = parse_address(address)
+    if isinstance(addr, str):
+        remove_socket(addr)
+        server = UnixHTTPServer(addr, ConversionHandler)
+    else:
+        server = LocalHTTPServer(addr, ConversionHandler)
+    server.service = ConversionService(converter_factory, workers, logger)
+    logger.info('Serving conversions on {} with {} workers.'.format(
+        address, workers))
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(addr, str):
+            remove_socket(addr)
+
+
+def terminate(signum, frame):
+    # Stops the service gracefully, as on an interrupt.
+    raise KeyboardInterrupt()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        self.unix_path = path
+        super(self.__class__, self).__init__('localhost')
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+
+def submit(address, job):
+    addr = parse_address(address)
+    if isinstance(addr, str):
+        conn = UnixHTTPConnection(addr)
+    else:
+        conn = http.client.HTTPConnection(*addr)
+    try:
+        conn.request('POST', '/convert', json.dumps(job),
+                     {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError) as e:
+        raise YamconvError(
+            'Failed to submit the job to {}: {}'.format(address, e))
+    finally:
+        conn.close()
@@ -0,0 +1,261 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains the external shuffle and sort of records, which spill
+the records to temporary files when they do not fit in the memory budget.
+>>> from mlt.mlt import MultiLabelText
+>>> mlts = [MultiLabelText(str(i), str(i)) for i in range(100)]
+>>> def shuffled(memory, seed):
+...     shuffler = ExternalShuffler(memory, seed)
+...     return [mlt.idstr for mlt in shuffler.shuffle(iter(mlts))]
+>>> ids = shuffled(1 << 20, 42)
+>>> sorted(ids, key=int) == [mlt.idstr for mlt in mlts]
+True
+>>> ids == [mlt.idstr for mlt in mlts]
+False
+>>> ids == shuffled(1 << 20, 42)
+True
+>>> spilled_ids = shuffled(2000, 42)
+>>> sorted(spilled_ids, key=int) == [mlt.idstr for mlt in mlts]
+True
+>>> spilled_ids == shuffled(2000, 42)
+True
+>>> shuffler = ExternalShuffler(1 << 20, 42)
+>>> shuffler.pressure = True
+>>> [mlt.idstr for mlt in shuffler.shuffle(iter(mlts))] == ids
+True
+>>> sorter = ExternalSorter('text_length', 2000)
+>>> lengths = [len(mlt.text) for mlt in sorter.sort(iter(mlts[::-1]))]
+>>> lengths == sorted(lengths)
+True
+"""
+
+import os
+import pickle
+import random
+import shutil
+import tempfile
+from heapq import merge
+from itertools import chain
+from mlt.mlt import MultiLabelText
+
+# The approximate memory used by a record in addition to its contents
+RECORD_OVERHEAD = 400
+MAX_BUCKETS = 256
+
+
+def record_size(mlt):
+    return RECORD_OVERHEAD + len(mlt.text) + \
+        sum(len(label) for label in mlt.labels)
+
+
+class SpillFile:
+    """A temporary file of pickled records."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.size = 0
+        self.count = 0
+
+    def write(self, mlt):
+        pickle.dump((mlt.idstr, mlt.text, list(mlt.labels)), self.file,
+                    pickle.HIGHEST_PROTOCOL)
+        self.size += record_size(mlt)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            for _ in range(self.count):
+                idstr, text, labels = pickle.load(f)
+                mlt = MultiLabelText(text, idstr)
+                for label in labels:
+                    mlt.add_label(label)
+                yield mlt
+
+    def remove(self):
+        os.remove(self.path)
+
+
+class Spiller:
+    def __init__(self, memory, spill_dir=None):
+        self.memory = memory
+        self.spill_dir = spill_dir
+        self.tmp_dir = None
+        self.nfiles = 0
+        self.pressure = False
+
+    def over_memory(self, size):
+        # The records are spilled early when the memory is under pressure.
+        if self.pressure:
+            self.pressure = False
+            return True
+        return size > self.memory
+
+    def new_spill_file(self):
+        if not self.tmp_dir:
+            self.tmp_dir = tempfile.mkdtemp(
+                prefix='yamconv-', dir=self.spill_dir)
+        self.nfiles += 1
+        return SpillFile(os.path.join(
+            self.tmp_dir, '{}.spill'.format(self.nfiles)))
+
+    def remove_spill_files(self):
+        if self.tmp_dir:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+
+class ExternalShuffler(Spiller):
+    """Scatters the records into random buckets, which are kept in memory if
+    the records fit in `memory` bytes or otherwise spilled to disk, and then
+    shuffles each bucket in memory. A bucket that is still too large is
+    scattered again."""
+
+    def __init__(self, memory, seed=None, spill_dir=None, expected_size=0):
+        self.random = random.Random(seed)
+        self.expected_size = expected_size
+        super(self.__class__, self).__init__(memory, spill_dir)
+
+    def nbuckets(self, size):
+        n = (2 * size) // self.memory + 1
+        return max(2, min(n, MAX_BUCKETS))
+
+    def scatter(self, mlts, nbuckets):
+        buckets = [self.new_spill_file() for _ in range(nbuckets)]
+        for mlt in mlts:
+            buckets[self.random.randrange(nbuckets)].write(mlt)
+        for bucket in buckets:
+            bucket.close()
+        return buckets
+
+    def shuffle(self, mlts):
+        # The records are assigned to the buckets in the same way whether or
+        # not they are spilled, so that the order only depends on the seed
+        # and not on when the memory runs short.
+        nbuckets = self.nbuckets(max(self.memory, self.expected_size))
+        try:
+            buffers = [[] for _ in range(nbuckets)]
+            buckets = None
+            size = 0
+            for mlt in mlts:
+                i = self.random.randrange(nbuckets)
+                if buckets:
+                    buckets[i].write(mlt)
+                    continue
+                buffers[i].append(mlt)
+                size += record_size(mlt)
+                if self.over_memory(size):
+                    buckets = [self.new_spill_file() for _ in range(nbuckets)]
+                    for bucket, buffer in zip(buckets, buffers):
+                        for buffered in buffer:
+                            bucket.write(buffered)
+                    buffers = None
+            if not buckets:
+                for buffer in buffers:
+                    self.random.shuffle(buffer)
+                    for mlt in buffer:
+                        yield mlt
+                return
+            for bucket in buckets:
+                bucket.close()
+            for mlt in self.shuffle_buckets(buckets):
+                yield mlt
+        finally:
+            self.remove_spill_files()
+
+    def shuffle_buckets(self, buckets):
+        for bucket in buckets:
+            if bucket.size > self.memory and bucket.count > 1:
+                sub_buckets = self.scatter(bucket, self.nbuckets(bucket.size))
+                bucket.remove()
+                for mlt in self.shuffle_buckets(sub_buckets):
+                    yield mlt
+                continue
+            mlts = list(bucket)
+            bucket.remove()
+            self.random.shuffle(mlts)
+            for mlt in mlts:
+                yield mlt
+
+
+SORT_KEYS = {
+    'id': lambda mlt: mlt.idstr or '',
+    # Records are grouped by their first label in lexical order
+    'label': lambda mlt: min(mlt.labels) if mlt.labels else '',
+    'text_length': lambda mlt: len(mlt.text),
+}
+
+
+class ExternalSorter(Spiller):
+    """Sorts the records in memory if they fit in `memory` bytes. Otherwise,
+    sorted runs of records are spilled to disk and then merged. The sort is
+    stable, so records with equal keys are kept in the input order."""
+
+    def __init__(self, sort_by, memory, spill_dir=None):
+        self.key = SORT_KEYS[sort_by]
+        super(self.__class__, self).__init__(memory, spill_dir)
+
+    def spill_run(self, buffer):
+        buffer.sort(key=self.key)
+        run = self.new_spill_file()
+        for mlt in buffer:
+            run.write(mlt)
+        run.close()
+        return run
+
+    def merge_runs(self, runs):
+        # Runs are merged in groups if there are too many files to open.
+        while len(runs) > MAX_BUCKETS:
+            merged = []
+            for i in range(0, len(runs), MAX_BUCKETS):
+                group = runs[i:i + MAX_BUCKETS]
+                run = self.new_spill_file()
+                for mlt in merge(*group, key=self.key):
+                    run.write(mlt)
+                run.close()
+                for old_run in group:
+                    old_run.remove()
+                merged.append(run)
+            runs = merged
+        return merge(*runs, key=self.key)
+
+    def sort(self, mlts):
+        try:
+            runs = []
+            buffer = []
+            size = 0
+            for mlt in mlts:
+                buffer.append(mlt)
+                size += record_size(mlt)
+                if self.over_memory(size):
+                    runs.append(self.spill_run(buffer))
+                    buffer = []
+                    size = 0
+            if not runs:
+                buffer.sort(key=self.key)
+                for mlt in buffer:
+                    yield mlt
+                return
+            if buffer:
+                runs.append(self.spill_run(buffer))
+                buffer = []
+            for mlt in self.merge_runs(runs):
+                yield mlt
+        finally:
+            self.remove_spill_files()
@@ -15,46 +15,235 @@
 
 import os
 import sqlite3
+from urllib.request import pathname2url
 from common.ex import YamconvError
 from mlt.mlt import gen_id, MultiLabelText, Reader, Writer
+from mlt.compress import TextCodec, train_dictionary
+from common.prepro import normalize_text
+
+BATCH_SIZE = 1000
+# The number of parameters in a query is limited before SQLite 3.32
+MAX_BATCH_SIZE = 10000 if sqlite3.sqlite_version_info >= (3, 32) else 900
+# The number of texts sampled to train a compression dictionary
+DICT_SAMPLES = 1000
 
 
 class SQLiteReader(Reader):
     def __init__(self, sqlite_path):
+        self.record_filter = None
+        self.batch_size = BATCH_SIZE
         super(self.__class__, self).__init__(sqlite_path)
 
+    def set_filter(self, record_filter):
+        self.record_filter = record_filter
+        return True
+
+    def label_condition(self):
+        """Returns the SQL condition and parameters on the `label` column of
+        the `labels` table to select the labels allowed by the filter."""
+        conds, params = [], []
+        f = self.record_filter
+        if not f:
+            return '1', params
+        if f.include_labels is not None:
+            conds.append('label IN ({})'.format(
+                ', '.join('?' * len(f.include_labels))))
+            params.extend(sorted(f.include_labels))
+        if f.exclude_labels:
+            conds.append('label NOT IN ({})'.format(
+                ', '.join('?' * len(f.exclude_labels))))
+            params.extend(sorted(f.exclude_labels))
+        if f.min_label_count:
+            conds.append('label IN temp.frequent_labels')
+        if not conds:
+            return '1', params
+        return ' AND '.join(conds), params
+
     def open(self):
         if not os.path.isfile(self.filepath):
             raise YamconvError(
                 'Input file {} does not exists.'.format(self.filepath))
         self.conn = sqlite3.connect(self.filepath)
-        self.cur = self.conn.cursor()
-        self.cur.execute('SELECT id FROM texts')
-        rows = self.cur.fetchall()
-        self.text_ids = [row[0] for row in rows]
-        self.cur.execute('SELECT DISTINCT label FROM labels ORDER BY label')
+        self.prepare()
+        self.ids_cur = None
+        self.batch = []
+        self.cur.execute(
+            'SELECT DISTINCT label FROM labels WHERE {} '
+            'ORDER BY label'.format(self.label_cond),
+            self.label_params)
         rows = self.cur.fetchall()
         self.labels = [row[0] for row in rows]
 
-    def read(self):
-        try:
-            text_id = self.text_ids.pop()
-        except:
-            return None
+    def open_readonly(self):
+        """Opens a read-only connection for reading partitions, which can be
+        used by multiple processes concurrently."""
+        if not os.path.isfile(self.filepath):
+            raise YamconvError(
+                'Input file {} does not exists.'.format(self.filepath))
+        self.conn = sqlite3.connect(
+            'file:{}?mode=ro'.format(pathname2url(
+                os.path.abspath(self.filepath))),
+            uri=True)
+        self.prepare()
+
+    def prepare(self):
+        self.cur = self.conn.cursor()
+        if self.record_filter and self.record_filter.min_label_count:
+            # The frequent labels are computed once from the label index.
+            self.cur.execute(
+                'CREATE TEMP TABLE frequent_labels '
+                '(label TEXT NOT NULL PRIMARY KEY)')
+            self.cur.execute(
+                'INSERT INTO temp.frequent_labels SELECT label FROM labels '
+                'GROUP BY label HAVING COUNT(*) >= ?',
+                (self.record_filter.min_label_count, ))
+        self.label_cond, self.label_params = self.label_condition()
+        self.codec = None
+        self.cur.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'meta'")
+        if self.cur.fetchone():
+            self.cur.execute('SELECT key, value FROM meta')
+            meta = dict(self.cur.fetchall())
+            if meta.get('text_compression'):
+                self.codec = TextCodec(
+                    meta['text_compression'], meta.get('text_dictionary'))
+        self.required = self.record_filter.required_labels() \
+            if self.record_filter else 0
+        self.text_cond, self.text_params = '1', []
+        if self.record_filter and self.record_filter.match:
+            self.cur.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' "
+                "AND name = 'texts_fts'")
+            if not self.cur.fetchone():
+                raise YamconvError(
+                    'Input file {} has no full-text index for match'.format(
+                        self.filepath))
+            self.text_cond = 'rowid IN (SELECT rowid FROM texts_fts ' \
+                'WHERE texts_fts MATCH ?)'
+            self.text_params = [self.record_filter.match_phrase()]
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
+    def query_text_ids(self):
+        limit = ''
+        if self.record_filter and self.record_filter.limit:
+            limit = ' LIMIT {:d}'.format(self.record_filter.limit)
+        self.ids_cur = self.conn.cursor()
+        # The texts are read in rowid order as in the partitions, so that the
+        # records picked by the limit do not depend on the number of workers.
+        if self.text_params:
+            # The texts matched by the full-text index are selected first.
+            sql = 'SELECT id FROM texts WHERE {}'.format(self.text_cond)
+            params = self.text_params
+            if self.required:
+                sql += ' AND (SELECT COUNT(*) FROM labels WHERE ' \
+                    'text_id = texts.id AND {}) >= ?'.format(self.label_cond)
+                params = params + self.label_params + [self.required]
+            self.ids_cur.execute(sql + ' ORDER BY rowid' + limit, params)
+        elif self.required:
+            # Only the texts with enough allowed labels are selected
+            # through the label index.
+            self.ids_cur.execute(
+                'SELECT text_id FROM labels JOIN texts ON text_id = id '
+                'WHERE {} GROUP BY text_id HAVING COUNT(*) >= ? '
+                'ORDER BY MIN(texts.rowid){}'.format(self.label_cond, limit),
+                self.label_params + [self.required])
+        else:
+            self.ids_cur.execute(
+                'SELECT id FROM texts ORDER BY rowid{}'.format(limit))
+
+    def read_batch(self):
+        """Reads the texts and labels of the next batch of text ids, and
+        returns them in reversed order to be popped."""
+        text_ids = [row[0] for row in self.ids_cur.fetchmany(
+            min(self.batch_size, MAX_BATCH_SIZE))]
+        if not text_ids:
+            return []
+        marks = ', '.join('?' * len(text_ids))
         self.cur.execute(
-            'SELECT text FROM texts WHERE id = ?', (text_id, ))
-        row = self.cur.fetchone()
-        mlt = MultiLabelText(row[0], text_id)
+            'SELECT id, text FROM texts WHERE id IN ({})'.format(marks),
+            text_ids)
+        texts = dict(self.cur.fetchall())
         self.cur.execute(
-            'SELECT label FROM labels WHERE text_id = ?', (text_id, ))
-        rows = self.cur.fetchall()
-        for row in rows:
-            mlt.add_label(row[0])
-        return mlt
+            'SELECT text_id, label FROM labels WHERE text_id IN ({}) '
+            'AND {}'.format(marks, self.label_cond),
+            text_ids + self.label_params)
+        labels = {}
+        for text_id, label in self.cur.fetchall():
+            labels.setdefault(text_id, []).append(label)
+        mlts = []
+        for text_id in reversed(text_ids):
+            mlt = MultiLabelText(self.decode(texts[text_id]), text_id)
+            for label in labels.get(text_id, []):
+                mlt.add_label(label)
+            mlts.append(mlt)
+        return mlts
+
+    def decode(self, text):
+        if self.codec:
+            return self.codec.decompress(text)
+        return text
+
+    def read(self):
+        if self.ids_cur is None:
+            self.query_text_ids()
+        if not self.batch:
+            self.batch = self.read_batch()
+            if not self.batch:
+                return None
+        return self.batch.pop()
+
+    def partitions(self, size):
+        """Splits the texts into rowid ranges of at most `size` rows."""
+        self.cur.execute('SELECT MIN(rowid), MAX(rowid) FROM texts')
+        first, last = self.cur.fetchone()
+        if first is None:
+            return []
+        return [(lo, min(lo + size - 1, last))
+                for lo in range(first, last + 1, size)]
+
+    def read_partition(self, partition):
+        first, last = partition
+        if self.required:
+            self.cur.execute(
+                'SELECT id, text FROM texts AS t '
+                'WHERE rowid BETWEEN ? AND ? AND {} AND (SELECT COUNT(*) '
+                'FROM labels WHERE text_id = t.id AND {}) >= ? '
+                'ORDER BY rowid'.format(self.text_cond, self.label_cond),
+                [first, last] + self.text_params + self.label_params +
+                [self.required])
+        else:
+            self.cur.execute(
+                'SELECT id, text FROM texts WHERE rowid BETWEEN ? AND ? '
+                'AND {} ORDER BY rowid'.format(self.text_cond),
+                [first, last] + self.text_params)
+        mlts = [MultiLabelText(self.decode(text), text_id)
+                for text_id, text in self.cur.fetchall()]
+        self.cur.execute(
+            'SELECT text_id, label FROM texts JOIN labels '
+            'ON text_id = id WHERE texts.rowid BETWEEN ? AND ? '
+            'AND {}'.format(self.label_cond),
+            [first, last] + self.label_params)
+        labels = {}
+        for text_id, label in self.cur.fetchall():
+            labels.setdefault(text_id, []).append(label)
+        for mlt in mlts:
+            for label in labels.get(mlt.idstr, []):
+                mlt.add_label(label)
+        return mlts
 
     def close(self):
         self.conn.close()
 
+    def __getstate__(self):
+        # Connections are not passed to the worker processes.
+        state = self.__dict__.copy()
+        for key in ['conn', 'cur', 'ids_cur', 'batch', 'codec']:
+            state.pop(key, None)
+        return state
+
 
 schema = '''
         DROP TABLE IF EXISTS texts;
@@ -71,29 +260,158 @@ schema = '''
         DROP INDEX IF EXISTS label_index;
         CREATE INDEX label_index ON labels (label);
         CREATE INDEX text_id_index ON labels (text_id);
+        DROP TABLE IF EXISTS texts_fts;
+        DROP TABLE IF EXISTS meta;
+        CREATE TABLE meta (
+            key TEXT NOT NULL PRIMARY KEY,
+            value
+        );
+    '''
+
+
+# The indexes of the labels are built after a bulk load.
+label_indexes = '''
+        CREATE INDEX IF NOT EXISTS label_index ON labels (label);
+        CREATE INDEX IF NOT EXISTS text_id_index ON labels (text_id);
+    '''
+
+
+# The tables of a temporary database loaded by a worker, where the labels
+# refer to the rowids of the texts, and the ids are resolved in the merge.
+part_schema = '''
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE texts (
+            id TEXT,
+            text
+        );
+        CREATE TABLE labels (
+            text_rowid INTEGER NOT NULL,
+            label TEXT NOT NULL
+        );
+    '''
+
+
+append_schema = '''
+        CREATE TABLE IF NOT EXISTS texts (
+            id TEXT NOT NULL PRIMARY KEY,
+            text TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS labels (
+            label TEXT NOT NULL,
+            text_id text NOT NULL,
+            FOREIGN KEY (text_id) REFERENCES texts(id)
+        );
+        CREATE INDEX IF NOT EXISTS label_index ON labels (label);
+        CREATE INDEX IF NOT EXISTS text_id_index ON labels (text_id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT NOT NULL PRIMARY KEY,
+            value
+        );
     '''
 
 
 class SQLiteWriter(Writer):
     def __init__(self, sqlite_path):
+        self.compression = None
+        self.train_dict = False
+        self.follow = False
+        self.append = False
+        self.fts_index = False
+        self.bulk_load = False
+        self.analyze = False
+        self.vacuum = False
         super(self.__class__, self).__init__(sqlite_path)
 
+    def set_bulk_load(self, analyze=False, vacuum=False):
+        # The label indexes are built when the loaded databases are merged.
+        self.bulk_load = True
+        self.analyze = analyze
+        self.vacuum = vacuum
+        return True
+
+    def set_fts_index(self):
+        self.fts_index = True
+        return True
+
+    def set_follow(self, append):
+        # The records are committed in a transaction at every flush.
+        self.follow = True
+        self.append = append
+        return True
+
+    def set_compression(self, compression, train_dict=False):
+        self.compression = compression
+        self.train_dict = train_dict
+        return True
+
     def open(self):
         self.conn = sqlite3.connect(self.filepath)
         # Can use autocommit for faster performance
         # self.conn.isolation_level = None
         self.cur = self.conn.cursor()
+        self.codec = None
+        self.samples = None
+        if self.append:
+            self.cur.executescript(append_schema)
+            self.cur.execute('SELECT key, value FROM meta')
+            meta = dict(self.cur.fetchall())
+            if meta.get('text_compression'):
+                # The existing texts determine the compression.
+                self.codec = TextCodec(
+                    meta['text_compression'], meta.get('text_dictionary'))
+            return
         self.cur.executescript(schema)
+        if self.bulk_load:
+            self.cur.executescript('''
+                DROP INDEX label_index;
+                DROP INDEX text_id_index;
+            ''')
+        if self.compression:
+            if self.train_dict:
+                # The texts are held until the dictionary is trained.
+                self.samples = []
+            else:
+                self.start_compression(None)
+
+    def start_compression(self, zdict):
+        self.codec = TextCodec(self.compression, zdict)
+        self.cur.execute(
+            'INSERT INTO meta (key, value) VALUES (?, ?)',
+            ('text_compression', self.compression, ))
+        if zdict:
+            self.cur.execute(
+                'INSERT INTO meta (key, value) VALUES (?, ?)',
+                ('text_dictionary', zdict, ))
+
+    def flush_samples(self):
+        samples = self.samples
+        self.samples = None
+        self.start_compression(
+            train_dictionary(mlt.text for mlt in samples))
+        for mlt in samples:
+            self.insert(mlt)
 
     def write(self, mlt):
+        if self.samples is not None:
+            self.samples.append(mlt)
+            if len(self.samples) >= DICT_SAMPLES:
+                self.flush_samples()
+            return
+        self.insert(mlt)
+
+    def insert(self, mlt):
         idstr = mlt.idstr
         if not idstr:
             idstr = gen_id()
+        text = mlt.text
+        if self.codec:
+            text = self.codec.compress(text)
         while(True):
             try:
                 self.cur.execute(
                     'INSERT INTO texts (id, text) VALUES (?, ?)',
-                    (idstr, mlt.text, ))
+                    (idstr, text, ))
                 break
             except sqlite3.IntegrityError as e:
                 idstr = gen_id()
@@ -102,8 +420,108 @@ class SQLiteWriter(Writer):
             self.cur.execute(
                 'INSERT INTO labels (label, text_id) VALUES (?, ?)',
                 (label, idstr, ))
-        self.conn.commit()  # Can omit this commit for autocommit
+        if not self.follow:
+            self.conn.commit()  # Can omit this commit for autocommit
+
+    def flush(self):
+        if self.samples is not None:
+            self.flush_samples()
+        self.conn.commit()
+
+    def write_part(self, part_path, mlts):
+        """Writes the records to a temporary database in a worker process,
+        and returns the number of records."""
+        conn = sqlite3.connect(part_path)
+        conn.executescript(part_schema)
+        count = 0
+        for mlt in mlts:
+            text = mlt.text
+            if self.codec:
+                text = self.codec.compress(text)
+            cur = conn.execute(
+                'INSERT INTO texts (id, text) VALUES (?, ?)',
+                (mlt.idstr or None, text, ))
+            conn.executemany(
+                'INSERT INTO labels (text_rowid, label) VALUES (?, ?)',
+                [(cur.lastrowid, label) for label in mlt.labels])
+            count += 1
+        conn.commit()
+        conn.close()
+        return count
+
+    def merge_part(self, part_path, offset):
+        """Merges a temporary database after `offset` records in a
+        transaction. The records without an id are given a random id like
+        `gen_id`. An id that is already taken by a previous record is
+        suffixed with the position of the record in the output, so that the
+        same input is always merged into the same ids."""
+        self.conn.commit()
+        self.cur.execute('ATTACH DATABASE ? AS part', (part_path, ))
+        try:
+            self.cur.execute(
+                'UPDATE part.texts SET id = lower(hex(randomblob(16))) '
+                'WHERE id IS NULL')
+            self.cur.execute('CREATE INDEX part.part_id_index ON texts (id)')
+            while True:
+                self.cur.execute(
+                    "UPDATE part.texts SET id = id || '-' || (? + rowid) "
+                    'WHERE id IN (SELECT id FROM main.texts) '
+                    'OR rowid > (SELECT MIN(rowid) FROM part.texts AS t '
+                    'WHERE t.id = texts.id)', (offset, ))
+                if self.cur.rowcount <= 0:
+                    break
+            self.cur.execute(
+                'INSERT INTO main.texts (id, text) '
+                'SELECT id, text FROM part.texts ORDER BY rowid')
+            self.cur.execute(
+                'INSERT INTO main.labels (label, text_id) '
+                'SELECT l.label, t.id FROM part.labels AS l '
+                'JOIN part.texts AS t ON t.rowid = l.text_rowid '
+                'ORDER BY l.rowid')
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.cur.execute('DETACH DATABASE part')
+
+    def build_fts_index(self):
+        """Builds a contentless FTS5 table of the texts normalized like
+        `word_seq`, so that each CJK character is a token."""
+        codec = self.codec
+
+        def normalize(text):
+            if codec:
+                text = codec.decompress(text)
+            return normalize_text(text, True)
+
+        self.conn.create_function('yamconv_normalize', 1, normalize)
+        self.cur.executescript('''
+            DROP TABLE IF EXISTS texts_fts;
+            CREATE VIRTUAL TABLE texts_fts USING fts5(
+                text, content='', tokenize='unicode61 remove_diacritics 0');
+        ''')
+        self.cur.execute(
+            'INSERT INTO texts_fts (rowid, text) '
+            'SELECT rowid, yamconv_normalize(text) FROM texts')
 
     def close(self):
+        if self.samples is not None:
+            self.flush_samples()
+        if self.bulk_load:
+            self.cur.executescript(label_indexes)
+            if self.analyze:
+                self.cur.execute('ANALYZE')
+        if self.fts_index:
+            self.build_fts_index()
         self.conn.commit()
+        if self.vacuum:
+            self.cur.execute('VACUUM')
         self.conn.close()
+
+    def __getstate__(self):
+        # The connection is not passed to the worker processes.
+        state = self.__dict__.copy()
+        for key in ['conn', 'cur', 'samples']:
+            state.pop(key, None)
+        return state
@@ -0,0 +1,124 @@
+# coding=utf-8
+# Copyright 2019 YAM AI Machinery Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This module contains a collector of label statistics.
+>>> from mlt.mlt import MultiLabelText
+>>> stats = LabelStats(max_labels=2, top_k=2)
+>>> for labels in [['a', 'b'], ['a', 'c'], ['a', 'b'], []]:
+...     mlt = MultiLabelText('some text')
+...     for lab in labels:
+...         mlt.add_label(lab)
+...     stats.add(mlt)
+>>> result = stats.result()
+>>> result['records']
+4
+>>> result['labels_per_record']
+{'0': 1, '2': 3}
+>>> result['labels']['top'][0]
+['a', 3]
+>>> result['cooccurrences']['top'][0]
+['a', 'b', 2]
+"""
+
+import json
+from itertools import combinations
+
+
+class TopCounter:
+    """Counts items exactly as long as at most `capacity` distinct items are
+    seen. Beyond that, only the heaviest items are kept in the manner of the
+    space-saving algorithm and the counts become upper bounds that overestimate
+    by at most `error`."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def add(self, item):
+        count = self.counts.get(item)
+        if count is None:
+            self.counts[item] = self.error + 1
+            if len(self.counts) > 2 * self.capacity:
+                self.prune()
+        else:
+            self.counts[item] = count + 1
+
+    def prune(self):
+        items = sorted(self.counts.items(), key=lambda x: x[1], reverse=True)
+        self.error = max(self.error, items[self.capacity][1])
+        self.counts = dict(items[:self.capacity])
+
+    def exact(self):
+        return self.error == 0
+
+    def top(self, k=None):
+        items = sorted(self.counts.items(), key=lambda x: (-x[1], x[0]))
+        if k is not None:
+            items = items[:k]
+        return items
+
+
+class LabelStats:
+    def __init__(self, max_labels=100000, top_k=100):
+        self.top_k = top_k
+        self.records = 0
+        self.labels = TopCounter(max_labels)
+        self.pairs = TopCounter(max(max_labels, top_k))
+        self.labels_per_record = {}
+        self.text_lengths = {}
+
+    def add(self, mlt):
+        self.records += 1
+        n = len(mlt.labels)
+        self.labels_per_record[n] = self.labels_per_record.get(n, 0) + 1
+        # Text lengths are bucketed by powers of two
+        length = len(mlt.text)
+        bucket = 1 << (length - 1).bit_length() if length else 0
+        self.text_lengths[bucket] = self.text_lengths.get(bucket, 0) + 1
+        for label in mlt.labels:
+            self.labels.add(label)
+        if n > 1:
+            for pair in combinations(sorted(mlt.labels), 2):
+                self.pairs.add(pair)
+
+    def result(self):
+        return {
+            'records': self.records,
+            'labels': {
+                'distinct': len(self.labels.counts)
+                if self.labels.exact() else None,
+                'exact': self.labels.exact(),
+                'error': self.labels.error,
+                'top': [[label, count] for label, count
+                        in self.labels.top(self.top_k)],
+            },
+            'labels_per_record': {
+                str(n): count for n, count
+                in sorted(self.labels_per_record.items())},
+            'text_lengths': {
+                str(bucket): count for bucket, count
+                in sorted(self.text_lengths.items())},
+            'cooccurrences': {
+                'exact': self.pairs.exact(),
+                'error': self.pairs.error,
+                'top': [[a, b, count] for (a, b), count
+                        in self.pairs.top(self.top_k)],
+            },
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.result(), f, ensure_ascii=False, indent=2)
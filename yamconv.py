@@ -14,18 +14,46 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
 import getopt
+import signal
 import logging
-from json import loads
+from json import loads, dumps
+from mlt.stats import LabelStats
+from mlt.filter import RecordFilter
+from mlt.index import Indexer
+from mlt.spill import ExternalShuffler, ExternalSorter, SORT_KEYS
+from mlt.memory import MemoryBudget
+from mlt.compress import COMPRESSION_METHODS
+from mlt.service import serve, submit, terminate
 from mlt.conv import FastText2SQLite, SQLite2FastText, FastText2FastText, SQLite2SQLite,\
-    CSV2SQLite, CSV2FastText, SQLite2CSV, CSV2CSV
+    CSV2SQLite, CSV2FastText, SQLite2CSV, CSV2CSV, FastText2CSR, SQLite2CSR, CSV2CSR,\
+    FanOut, OUTPUT_FORMATS
 from common.ex import YamconvError
 
 NUM_LINES = 1000
+MB = 1024 * 1024
+SERVE = 'serve'
+SUBMIT = 'submit'
+SERVE_WORKERS = 4
 CACHE_LABELS = False
 NORMALIZE_LABELS = True
 WORD_SEQ = False
+STATS = False
+STATS_TOP_K = 100
+STATS_MAX_LABELS = 100000
+WORKERS = 1
+PARTITION_SIZE = 10000
+SHUFFLE = False
+SHUFFLE_MEMORY = 1024
+SORT_MEMORY = 1024
+COMPRESSION_DICT = False
+POLL_INTERVAL = 1
+FTS = False
+PARALLEL_LOAD = False
+ANALYZE = False
+VACUUM = False
 MLT_FASTTEXT_TO_SQLITE = 'mlt.fasttext2sqlite'
 MLT_SQLITE_TO_FASTTEXT = 'mlt.sqlite2fasttext'
 MLT_FASTTEXT_TO_FASTTEXT = 'mlt.fasttext2fasttext'
@@ -34,20 +62,45 @@ MLT_CSV_TO_SQLITE = 'mlt.csv2sqlite'
 MLT_CSV_TO_FASTTEXT = 'mlt.csv2fasttext'
 MLT_SQLITE_TO_CSV = 'mlt.sqlite2csv'
 MLT_CSV_TO_CSV = 'mlt.csv2csv'
+MLT_FASTTEXT_TO_CSR = 'mlt.fasttext2csr'
+MLT_SQLITE_TO_CSR = 'mlt.sqlite2csr'
+MLT_CSV_TO_CSR = 'mlt.csv2csr'
+MLT_FASTTEXT_TO_MULTI = 'mlt.fasttext2multi'
+MLT_SQLITE_TO_MULTI = 'mlt.sqlite2multi'
+MLT_CSV_TO_MULTI = 'mlt.csv2multi'
+# The input formats of the converters to multiple outputs
+MULTI_INPUT_FORMATS = {
+    MLT_FASTTEXT_TO_MULTI: 'fasttext',
+    MLT_SQLITE_TO_MULTI: 'sqlite',
+    MLT_CSV_TO_MULTI: 'csv',
+}
+MLT_FASTTEXT_TO_INDEX = 'mlt.fasttext2index'
+MLT_CSV_TO_INDEX = 'mlt.csv2index'
 
 
 def main(argv):
+    if len(argv) > 1 and argv[1] == SERVE:
+        serve_main(argv)
+        return
+    if len(argv) > 1 and argv[1] == SUBMIT:
+        submit_main(argv)
+        return
     progname = argv[0]
     log_level = logging.WARN
     infile, outfile, convert, settings = None, None, None, None
+    outfiles = []
+    follow = False
     try:
-        opts, _ = getopt.getopt(argv[1:], 'i:o:c:s:v')
+        opts, _ = getopt.getopt(argv[1:], 'i:o:c:s:v', ['follow'])
         for opt, arg in opts:
+            if opt == '--follow':
+                follow = True
+                continue
             if opt == '-i':
                 infile = arg
                 continue
             if opt == '-o':
-                outfile = arg
+                outfiles.append(arg)
                 continue
             if opt == '-c':
                 convert = arg
@@ -64,27 +117,132 @@ def main(argv):
         err(progname, e)
     if not infile:
         err(progname, Exception('-i is missing'))
-    if not outfile:
+    if not outfiles:
         err(progname, Exception('-o is missing'))
     if not convert:
         err(progname, Exception('-c is missing'))
+    if convert in MULTI_INPUT_FORMATS:
+        outfile = outfiles
+    elif len(outfiles) > 1:
+        err(progname, Exception(
+            '-o can be given more than once only to the *2multi converters'))
+    else:
+        outfile = outfiles[0]
     logger = get_logger(log_level)
     try:
         converter = get_converter(
             convert, infile, outfile,
-            settings, logger, NUM_LINES)
+            settings, logger, NUM_LINES, follow)
     except Exception as e:
         err(progname, e)
     if not converter:
         err(progname,
             Exception('Unknown converter name {}'.format(convert)))
+    if follow:
+        # Termination stops following gracefully, as on an interrupt.
+        signal.signal(signal.SIGTERM, terminate)
     try:
         converter.convert()
     except YamconvError as e:
         print('Failed to convert data: {}'.format(e), file=sys.stderr)
 
 
-def get_converter(name, infile, outfile, settings, logger, nlines):
+def serve_main(argv):
+    progname = argv[0]
+    log_level = logging.WARN
+    address, workers = None, SERVE_WORKERS
+    try:
+        opts, _ = getopt.getopt(argv[2:], 'a:w:v')
+        for opt, arg in opts:
+            if opt == '-a':
+                address = arg
+                continue
+            if opt == '-w':
+                try:
+                    workers = int(arg)
+                except ValueError:
+                    raise Exception('-w workers not an integer')
+                continue
+            if opt == '-v':
+                log_level = logging.INFO
+                continue
+    except Exception as e:
+        err(progname, e)
+    if not address:
+        err(progname, Exception('-a is missing'))
+    logger = get_logger(log_level)
+
+    def converter_factory(name, infile, outfile, settings):
+        return get_converter(
+            name, infile, outfile,
+            settings, logger, NUM_LINES)
+
+    try:
+        serve(address, converter_factory, workers, logger)
+    except Exception as e:
+        err(progname, e)
+
+
+def submit_main(argv):
+    progname = argv[0]
+    address, infile, outfile, convert, settings = \
+        None, None, None, None, None
+    outfiles = []
+    try:
+        opts, _ = getopt.getopt(argv[2:], 'a:i:o:c:s:')
+        for opt, arg in opts:
+            if opt == '-a':
+                address = arg
+                continue
+            if opt == '-i':
+                infile = arg
+                continue
+            if opt == '-o':
+                outfiles.append(arg)
+                continue
+            if opt == '-c':
+                convert = arg
+                continue
+            if opt == '-s':
+                try:
+                    settings = loads(arg)
+                except Exception as e:
+                    raise Exception("-s settings not in JSON")
+                continue
+    except Exception as e:
+        err(progname, e)
+    if not address:
+        err(progname, Exception('-a is missing'))
+    if not infile:
+        err(progname, Exception('-i is missing'))
+    if not outfiles:
+        err(progname, Exception('-o is missing'))
+    if not convert:
+        err(progname, Exception('-c is missing'))
+    # Paths are resolved here since the service may run in another directory.
+    if convert in MULTI_INPUT_FORMATS:
+        outfile = [resolve_output(spec) for spec in outfiles]
+    elif len(outfiles) > 1:
+        err(progname, Exception(
+            '-o can be given more than once only to the *2multi converters'))
+    else:
+        outfile = os.path.abspath(outfiles[0])
+    job = {'converter': convert,
+           'input': os.path.abspath(infile),
+           'output': outfile,
+           'settings': settings}
+    try:
+        result = submit(address, job)
+    except YamconvError as e:
+        print('Failed to submit the job: {}'.format(e), file=sys.stderr)
+        sys.exit(1)
+    print(dumps(result))
+    if result.get('status') != 'ok':
+        sys.exit(1)
+
+
+def get_converter(name, infile, outfile, settings, logger, nlines,
+                  follow=False):
     converter = None
     cache_labels = get_boolean_setting(
         settings, 'cache_labels', CACHE_LABELS,
@@ -95,65 +253,279 @@ def get_converter(name, infile, outfile, settings, logger, nlines):
     word_seq = get_boolean_setting(
         settings, 'word_seq', WORD_SEQ,
         logger)
+    options = {}
+    if get_boolean_setting(settings, 'stats', STATS, logger):
+        options['stats'] = LabelStats(
+            max_labels=get_int_setting(
+                settings, 'stats_max_labels', STATS_MAX_LABELS,
+                logger),
+            top_k=get_int_setting(
+                settings, 'stats_top_k', STATS_TOP_K,
+                logger))
+    record_filter = get_record_filter(settings, logger)
+    if record_filter:
+        options['record_filter'] = record_filter
+    options['workers'] = get_int_setting(
+        settings, 'workers', WORKERS, logger)
+    options['partition_size'] = get_int_setting(
+        settings, 'partition_size', PARTITION_SIZE, logger)
+    spill_memory = None
+    memory_limit = get_int_setting(
+        settings, 'memory_limit', None, logger)
+    if memory_limit:
+        options['memory_budget'] = MemoryBudget(memory_limit * MB)
+        spill_memory = options['memory_budget'].spill_memory // MB
+    spill_dir = get_string_setting(settings, 'spill_dir', None, logger)
+    if get_boolean_setting(settings, 'shuffle', SHUFFLE, logger):
+        options['shuffler'] = ExternalShuffler(
+            memory=get_int_setting(
+                settings, 'shuffle_memory', spill_memory or SHUFFLE_MEMORY,
+                logger) * MB,
+            seed=get_int_setting(
+                settings, 'seed', None, logger, minimum=0),
+            spill_dir=spill_dir,
+            expected_size=get_file_size(infile))
+    sort_by = get_string_setting(settings, 'sort_by', None, logger)
+    if sort_by:
+        if sort_by not in SORT_KEYS:
+            raise YamconvError('sort_by must be one of {}'.format(
+                ', '.join(SORT_KEYS)))
+        if 'shuffler' in options:
+            raise YamconvError('sort_by cannot be used with shuffle')
+        options['sorter'] = ExternalSorter(
+            sort_by,
+            memory=get_int_setting(
+                settings, 'sort_memory', spill_memory or SORT_MEMORY,
+                logger) * MB,
+            spill_dir=spill_dir)
+    if name not in MULTI_INPUT_FORMATS:
+        # The outputs of a fan-out are compressed and indexed by themselves.
+        options.update(get_compression_options(settings, logger))
+        options['fts_index'] = get_boolean_setting(
+            settings, 'fts', FTS, logger)
+    max_errors = get_int_setting(settings, 'max_errors', None, logger)
+    if max_errors:
+        options['max_errors'] = max_errors
+        options['quarantine'] = get_string_setting(
+            settings, 'quarantine', None, logger)
+    if get_boolean_setting(settings, 'parallel_load', PARALLEL_LOAD, logger):
+        options['parallel_load'] = True
+        options['analyze'] = get_boolean_setting(
+            settings, 'analyze', ANALYZE, logger)
+        options['vacuum'] = get_boolean_setting(
+            settings, 'vacuum', VACUUM, logger)
+    if follow:
+        options['follow'] = True
+        options['poll_interval'] = get_int_setting(
+            settings, 'poll_interval', POLL_INTERVAL, logger)
     if name == MLT_FASTTEXT_TO_SQLITE:
         converter = FastText2SQLite(
             infile, outfile,
             normalize_labels=normalize_labels,
             word_seq=word_seq,
             cache_labels=cache_labels,
-            logger=logger, nlines=nlines)
+            logger=logger, nlines=nlines, **options)
     elif name == MLT_SQLITE_TO_FASTTEXT:
         converter = SQLite2FastText(
             infile, outfile,
             normalize_labels=normalize_labels,
             word_seq=word_seq,
             cache_labels=cache_labels,
-            logger=logger, nlines=nlines)
+            logger=logger, nlines=nlines, **options)
     elif name == MLT_FASTTEXT_TO_FASTTEXT:
         converter = FastText2FastText(
             infile, outfile,
             normalize_labels=normalize_labels,
             word_seq=word_seq,
             cache_labels=cache_labels,
-            logger=logger, nlines=nlines)
+            logger=logger, nlines=nlines, **options)
     elif name == MLT_SQLITE_TO_SQLITE:
         converter = SQLite2SQLite(
             infile, outfile,
             normalize_labels=normalize_labels,
             word_seq=word_seq,
             cache_labels=cache_labels,
-            logger=logger, nlines=nlines)
+            logger=logger, nlines=nlines, **options)
     elif name == MLT_CSV_TO_SQLITE:
         converter = CSV2SQLite(
             infile, outfile,
             normalize_labels=normalize_labels,
             word_seq=word_seq,
             cache_labels=cache_labels,
-            logger=logger, nlines=nlines)
+            logger=logger, nlines=nlines, **options)
     elif name == MLT_CSV_TO_FASTTEXT:
         converter = CSV2FastText(
             infile, outfile,
             normalize_labels=normalize_labels,
             word_seq=word_seq,
             cache_labels=cache_labels,
-            logger=logger, nlines=nlines)
+            logger=logger, nlines=nlines, **options)
     elif name == MLT_SQLITE_TO_CSV:
         converter = SQLite2CSV(
             infile, outfile,
             normalize_labels=normalize_labels,
             word_seq=word_seq,
             cache_labels=cache_labels,
-            logger=logger, nlines=nlines)
+            logger=logger, nlines=nlines, **options)
     elif name == MLT_CSV_TO_CSV:
         converter = CSV2CSV(
             infile, outfile,
             normalize_labels=normalize_labels,
             word_seq=word_seq,
             cache_labels=cache_labels,
-            logger=logger, nlines=nlines)
+            logger=logger, nlines=nlines, **options)
+    elif name == MLT_FASTTEXT_TO_CSR:
+        converter = FastText2CSR(
+            infile, outfile,
+            normalize_labels=normalize_labels,
+            word_seq=word_seq,
+            cache_labels=cache_labels,
+            logger=logger, nlines=nlines, **options)
+    elif name == MLT_SQLITE_TO_CSR:
+        converter = SQLite2CSR(
+            infile, outfile,
+            normalize_labels=normalize_labels,
+            word_seq=word_seq,
+            cache_labels=cache_labels,
+            logger=logger, nlines=nlines, **options)
+    elif name == MLT_CSV_TO_CSR:
+        converter = CSV2CSR(
+            infile, outfile,
+            normalize_labels=normalize_labels,
+            word_seq=word_seq,
+            cache_labels=cache_labels,
+            logger=logger, nlines=nlines, **options)
+    elif name in MULTI_INPUT_FORMATS:
+        if isinstance(outfile, str):
+            outfile = [outfile]
+        converter = FanOut(
+            MULTI_INPUT_FORMATS[name], infile,
+            [get_output(spec, settings, logger) for spec in outfile],
+            cache_labels=cache_labels,
+            logger=logger, nlines=nlines, **options)
+    elif name == MLT_FASTTEXT_TO_INDEX:
+        converter = Indexer(
+            infile, outfile, is_csv=False, logger=logger)
+    elif name == MLT_CSV_TO_INDEX:
+        converter = Indexer(
+            infile, outfile, is_csv=True, logger=logger)
     return converter
 
 
+def resolve_output(spec):
+    """Resolves the path of an output spec FORMAT:PATH[:{JSON}], which is
+    split in the same way as in `get_output`. A malformed spec is left to be
+    reported by `get_output`.
+    >>> resolve_output('csv:out.csv:{"word_seq": true}') == \\
+    ...     'csv:' + os.path.abspath('out.csv') + ':{"word_seq": true}'
+    True
+    >>> resolve_output('out.csv')
+    'out.csv'
+    """
+    out_format, sep, rest = spec.partition(':')
+    path, brace, output_settings = rest.partition(':{')
+    if not sep or out_format not in OUTPUT_FORMATS or not path:
+        return spec
+    return '{}:{}{}{}'.format(
+        out_format, os.path.abspath(path), brace, output_settings)
+
+
+def get_output(spec, settings, logger):
+    """Parses an output spec FORMAT:PATH[:{JSON}], where the JSON settings
+    of the output override the other settings.
+    >>> get_output('csv:out.csv', {'word_seq': True}, logging.getLogger())
+    {'format': 'csv', 'path': 'out.csv', 'normalize_labels': True, \
+'word_seq': True}
+    >>> get_output('sqlite:a:b.db:{"text_compression": "zlib"}', None,
+    ...            logging.getLogger())['path']
+    'a:b.db'
+    """
+    out_format, sep, rest = spec.partition(':')
+    if not sep or out_format not in OUTPUT_FORMATS:
+        raise YamconvError(
+            'Output {} is not FORMAT:PATH[:{{JSON}}] with a format in {}'
+            .format(spec, ', '.join(OUTPUT_FORMATS)))
+    path, sep, output_settings = rest.partition(':{')
+    settings = dict(settings or {})
+    if sep:
+        try:
+            settings.update(loads('{' + output_settings))
+        except Exception as e:
+            raise YamconvError('Settings of output {} not in JSON'.format(
+                path))
+    if not path:
+        raise YamconvError('Output {} has no path'.format(spec))
+    output = {
+        'format': out_format,
+        'path': path,
+        'normalize_labels': get_boolean_setting(
+            settings, 'normalize_labels', NORMALIZE_LABELS, logger),
+        'word_seq': get_boolean_setting(
+            settings, 'word_seq', WORD_SEQ, logger),
+    }
+    compression_options = get_compression_options(settings, logger)
+    if compression_options:
+        output.update(compression_options)
+    if get_boolean_setting(settings, 'fts', FTS, logger):
+        output['fts_index'] = True
+    return output
+
+
+def get_compression_options(settings, logger):
+    """Returns the text compression options of a SQLite output.
+    >>> get_compression_options({'text_compression': 'zlib',
+    ...     'compression_dict': True}, logging.getLogger())
+    {'text_compression': 'zlib', 'compression_dict': True}
+    >>> get_compression_options({'text_compression': 'lzma',
+    ...     'compression_dict': True}, logging.getLogger())
+    Traceback (most recent call last):
+    ...
+    common.ex.YamconvError: compression_dict is only supported by zlib \
+text_compression
+    """
+    options = {}
+    text_compression = get_string_setting(
+        settings, 'text_compression', None, logger)
+    if text_compression:
+        if text_compression not in COMPRESSION_METHODS:
+            raise YamconvError('text_compression must be one of {}'.format(
+                ', '.join(COMPRESSION_METHODS)))
+        options['text_compression'] = text_compression
+        options['compression_dict'] = get_boolean_setting(
+            settings, 'compression_dict', COMPRESSION_DICT, logger)
+        # The dictionary is rejected before any record is buffered.
+        if options['compression_dict'] and text_compression != 'zlib':
+            raise YamconvError(
+                'compression_dict is only supported by zlib text_compression')
+    return options
+
+
+def get_record_filter(settings, logger):
+    include_labels = get_list_setting(
+        settings, 'include_labels', None, logger)
+    exclude_labels = get_list_setting(
+        settings, 'exclude_labels', None, logger)
+    min_label_count = get_int_setting(
+        settings, 'min_label_count', None, logger)
+    min_labels = get_int_setting(
+        settings, 'min_labels', None, logger)
+    limit = get_int_setting(
+        settings, 'limit', None, logger)
+    match = get_string_setting(
+        settings, 'match', None, logger)
+    if include_labels is None and not exclude_labels and \
+            not min_label_count and not min_labels and not limit and \
+            not match:
+        return None
+    return RecordFilter(
+        include_labels=include_labels,
+        exclude_labels=exclude_labels,
+        min_label_count=min_label_count,
+        min_labels=min_labels,
+        limit=limit,
+        match=match)
+
+
 def get_boolean_setting(settings, key, default, logger):
     if not settings:
         return default
@@ -166,6 +538,51 @@ def get_boolean_setting(settings, key, default, logger):
     return value
 
 
+def get_int_setting(settings, key, default, logger, minimum=1):
+    if not settings:
+        return default
+    value = settings.get(key)
+    if value is None:
+        return default
+    if type(value) is not int or value < minimum:
+        raise YamconvError(
+            '{} must be an integer not less than {}'.format(key, minimum))
+    logger.info('{} = {}'.format(key, value))
+    return value
+
+
+def get_string_setting(settings, key, default, logger):
+    if not settings:
+        return default
+    value = settings.get(key)
+    if value is None:
+        return default
+    if not isinstance(value, str):
+        raise YamconvError('{} must be a string'.format(key))
+    logger.info('{} = {}'.format(key, value))
+    return value
+
+
+def get_list_setting(settings, key, default, logger):
+    if not settings:
+        return default
+    value = settings.get(key)
+    if value is None:
+        return default
+    if not isinstance(value, list) or \
+            not all(isinstance(v, str) for v in value):
+        raise YamconvError('{} must be a list of strings'.format(key))
+    logger.info('{} = {}'.format(key, value))
+    return value
+
+
+def get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
 def get_logger(log_level):
     ch = logging.StreamHandler()
     ch.setFormatter(
@@ -183,16 +600,27 @@ def err(progname, e=None):
     converter_names = [MLT_FASTTEXT_TO_SQLITE, MLT_SQLITE_TO_FASTTEXT,
                        MLT_FASTTEXT_TO_FASTTEXT, MLT_SQLITE_TO_SQLITE,
                        MLT_CSV_TO_SQLITE, MLT_CSV_TO_FASTTEXT,
-                       MLT_SQLITE_TO_CSV, MLT_CSV_TO_CSV]
-    print('Usage: {} -c converter -i input_file -o output_file -s settings -v'.format(progname),
+                       MLT_SQLITE_TO_CSV, MLT_CSV_TO_CSV,
+                       MLT_FASTTEXT_TO_CSR, MLT_SQLITE_TO_CSR, MLT_CSV_TO_CSR,
+                       MLT_FASTTEXT_TO_MULTI, MLT_SQLITE_TO_MULTI,
+                       MLT_CSV_TO_MULTI,
+                       MLT_FASTTEXT_TO_INDEX, MLT_CSV_TO_INDEX]
+    print('Usage: {} -c converter -i input_file -o output_file -s settings -v --follow'.format(progname),
           file=sys.stderr)
     print('-c: converter name', file=sys.stderr)
     print('-i: input file path', file=sys.stderr)
-    print('-o: output file path', file=sys.stderr)
+    print('-o: output file path, or FORMAT:PATH[:{JSON}] repeated for the *2multi converters', file=sys.stderr)
     print('-s: converter settings in JSON', file=sys.stderr)
     print('-v: verbose', file=sys.stderr)
+    print('--follow: keep converting the records appended to the input file', file=sys.stderr)
     print('Supported converters: {}'.format(
         ', '.join(converter_names)), file=sys.stderr)
+    print('Service usage: {} {} -a address -w workers -v'.format(
+        progname, SERVE), file=sys.stderr)
+    print('Client usage: {} {} -a address -c converter -i input_file -o output_file -s settings'.format(
+        progname, SUBMIT), file=sys.stderr)
+    print('-a: host:port or unix:path of the service', file=sys.stderr)
+    print('-w: number of concurrent jobs of the service', file=sys.stderr)
     if e:
         print('Error: {}'.format(e), file=sys.stderr)
     sys.exit(1)